@@ -0,0 +1,276 @@
+"""命令列介面：不開啟視窗即可更新資料庫、匯入學員、匯出報表及產生 QR Code，可用於排程執行
+
+範例：
+    python cli.py migrate
+    python cli.py import 學員.xlsx --duplicates overwrite
+    python cli.py import 名單.csv --dry-run --report 檢查結果.csv
+    python cli.py attendance --class 週三讀書會 --week 3 -o reports
+    python cli.py report --all-classes --format pdf -o reports
+    python cli.py students -o 學員資料.xlsx
+    python cli.py qrcodes --class 1 --class 2 -o qrcodes
+    python cli.py history -o checkins_20250610.jsonl --state history_state.json
+
+--class 可重複指定，值為課程 id 或名稱；不會載入 tkinter。
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import sqlite_db
+from sqlite_db import get_conn, close_conn
+from update_db import update_db
+from import_log import ImportRun
+from importer import (StudentImporter, ImportValidator, iter_xlsx_rows, iter_csv_rows, detect_encoding,
+                      DUPLICATE_ACTIONS, SKIP)
+from exporter import (load_session_attendance, export_attendance_pdf, load_attendance_matrix, export_matrix_xlsx,
+                      export_matrix_pdf, export_students_xlsx, export_class_qrcodes, export_checkin_history,
+                      HISTORY_FORMATS)
+
+ORG_INFO_FILE = "org_info.json"
+
+class CliError(Exception):
+    pass
+
+def load_org_info(file_path):
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {"org_name": "活動(課程)簽到系統", "manager": "", "contact": ""}
+
+def safe_filename(name):
+    # 課程名稱可能含有檔名不允許的字元
+    return re.sub(r'[\\/:*?"<>|]', "_", str(name)).strip() or "_"
+
+def select_classes(conn, selectors, all_classes):
+    """依 --class（id 或名稱）或 --all-classes 回傳 [(id, 名稱)]，找不到時拋出 CliError"""
+    classes = conn.execute("SELECT id, name FROM classes ORDER BY id").fetchall()
+    if all_classes:
+        return classes
+    if not selectors:
+        raise CliError("請以 --class 指定活動(課程)，或使用 --all-classes")
+    by_id = {str(class_id): (class_id, name) for class_id, name in classes}
+    selected = []
+    for selector in selectors:
+        matches = [by_id[selector]] if selector in by_id else [c for c in classes if c[1] == selector]
+        if not matches:
+            raise CliError(f"找不到活動(課程)：{selector}")
+        for match in matches:
+            if match not in selected:
+                selected.append(match)
+    return selected
+
+def select_sessions(conn, class_id, weeks, dates):
+    # 未指定 --week / --date 時為課程的所有堂次
+    sessions = conn.execute("""
+        SELECT id, week, date FROM sessions WHERE class_id=? ORDER BY week, date, id
+    """, (class_id,)).fetchall()
+    if not weeks and not dates:
+        return sessions
+    return [s for s in sessions if s[1] in weeks or s[2] in dates]
+
+def output_dir(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def cmd_migrate(conn, args):
+    print(f"資料庫版本：第 {update_db(conn)} 版")
+    return 0
+
+def cmd_import(conn, args):
+    file_path = args.file
+    if file_path.lower().endswith(".csv"):
+        kind = "attendees"
+        encoding = detect_encoding(file_path)
+        open_rows = lambda: iter_csv_rows(file_path, encoding)
+    else:
+        kind = "students"
+        open_rows = lambda: iter_xlsx_rows(file_path)
+
+    # 與匯入視窗相同：第一次讀檔檢查並比對重複學員，通過後再讀一次寫入
+    run = ImportRun(kind, file_path)
+    status = "error"
+    counts = {}
+    try:
+        validator = ImportValidator(conn)
+        importer = StudentImporter(conn)
+        with run.phase("check"):
+            conflicts = importer.find_conflicts(validator.check(open_rows()))
+        counts = {"rows": validator.rows, "errors": validator.errors,
+                  "warnings": validator.warnings, "conflicts": len(conflicts)}
+        run.log("checked", **counts)
+        print(f"檢查 {validator.rows} 筆：錯誤 {validator.errors}，警告 {validator.warnings}，"
+              f"資料不同的重複學員 {len(conflicts)} 位")
+        if args.report and validator.issues:
+            validator.write_report(args.report)
+            print(f"檢查結果已儲存至 {args.report}")
+        if args.dry_run or validator.errors:
+            status = "dry_run" if args.dry_run else "blocked"
+            if validator.errors:
+                print("檢查有錯誤，未匯入任何資料", file=sys.stderr)
+            return 1 if validator.errors else 0
+
+        decisions = {conflict["name"]: args.duplicates for conflict in conflicts}
+        with run.phase("import"):
+            result = importer.import_rows(validator.normalize(open_rows()), decisions)
+        status = "done"
+        counts.update(result)
+        print(f"匯入完成：新增 {result['added']} 位，更新 {result['updated']} 位，跳過 {result['skipped']} 位")
+        return 0
+    except Exception as e:
+        counts["error"] = str(e)
+        raise
+    finally:
+        run.finish(status, **counts)
+
+def cmd_attendance(conn, args):
+    org_info = load_org_info(args.org_info)
+    folder = output_dir(args.output)
+    weeks = set(args.week or [])
+    dates = set(args.date or [])
+    exported = 0
+    for class_id, class_name in select_classes(conn, args.classes, args.all_classes):
+        sessions = select_sessions(conn, class_id, weeks, dates)
+        if not sessions:
+            print(f"{class_name}：沒有符合的堂次", file=sys.stderr)
+            continue
+        for session_id, week, date in sessions:
+            _, session_info, records = load_session_attendance(conn, class_id, session_id)
+            file_path = os.path.join(folder, safe_filename(f"{class_name}_第{week}週_{date or session_id}") + ".pdf")
+            export_attendance_pdf(file_path, org_info, class_name, session_info, records)
+            print(file_path)
+            exported += 1
+    return 0 if exported else 1
+
+def cmd_report(conn, args):
+    org_info = load_org_info(args.org_info)
+    folder = output_dir(args.output)
+    for class_id, class_name in select_classes(conn, args.classes, args.all_classes):
+        matrix = load_attendance_matrix(conn, class_id)
+        file_path = os.path.join(folder, safe_filename(f"{class_name}_學期報表") + "." + args.format)
+        if args.format == "pdf":
+            export_matrix_pdf(file_path, org_info, class_name, matrix)
+        else:
+            export_matrix_xlsx(file_path, class_name, matrix)
+        print(file_path)
+    return 0
+
+def cmd_students(conn, args):
+    export_students_xlsx(conn, args.output)
+    print(args.output)
+    return 0
+
+def cmd_qrcodes(conn, args):
+    folder = output_dir(args.output)
+    status = 0
+    for class_id, class_name in select_classes(conn, args.classes, args.all_classes):
+        # 每個課程各自一個子資料夾
+        class_folder = output_dir(os.path.join(folder, safe_filename(class_name)))
+        count = export_class_qrcodes(conn, class_id, class_folder)
+        if not count:
+            print(f"{class_name}：此課堂尚無學員", file=sys.stderr)
+            status = 1
+        else:
+            print(f"{class_name}：{count} 張 QR Code 已儲存至 {class_folder}")
+    return status
+
+def load_history_state(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("since")
+
+def save_history_state(file_path, since):
+    # 先寫入暫存檔再取代，中斷時不會留下損壞的狀態檔
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"since": since}, f, ensure_ascii=False)
+    os.replace(tmp_path, file_path)
+
+def cmd_history(conn, args):
+    fmt = args.format or ("jsonl" if args.output.lower().endswith((".jsonl", ".json")) else "csv")
+    since = args.since
+    if since is None and args.state:
+        since = load_history_state(args.state)
+    count, high_water = export_checkin_history(conn, args.output, fmt, since)
+    print(f"匯出 {count} 筆簽到記錄至 {args.output}" + (f"（{since} 起）" if since else ""))
+    # 沒有新資料時保留原本的 since
+    if args.state and high_water:
+        save_history_state(args.state, high_water)
+    return 0
+
+def add_class_arguments(parser):
+    parser.add_argument("--class", dest="classes", action="append", metavar="ID或名稱",
+                        help="活動(課程) id 或名稱，可重複指定")
+    parser.add_argument("--all-classes", action="store_true", help="所有活動(課程)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="課程簽到系統命令列工具")
+    parser.add_argument("--db", help=f"資料庫檔案（預設 {sqlite_db.DB_FILE}）")
+    parser.add_argument("--org-info", default=ORG_INFO_FILE, help="單位資訊檔，用於 PDF 標題")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("migrate", help="更新資料庫結構")
+    p.set_defaults(func=cmd_migrate)
+
+    p = commands.add_parser("import", help="匯入學員（.xlsx 或 .csv）")
+    p.add_argument("file")
+    p.add_argument("--duplicates", choices=list(DUPLICATE_ACTIONS), default=SKIP,
+                   help="資料不同的重複學員處理方式（預設 skip）")
+    p.add_argument("--dry-run", action="store_true", help="只檢查，不寫入資料庫")
+    p.add_argument("--report", help="將檢查結果儲存為 CSV")
+    p.set_defaults(func=cmd_import)
+
+    p = commands.add_parser("attendance", help="匯出各堂次簽到記錄 PDF")
+    add_class_arguments(p)
+    p.add_argument("--week", type=int, action="append", help="週次，可重複指定；未指定時匯出所有堂次")
+    p.add_argument("--date", action="append", help="日期（YYYY-MM-DD），可重複指定")
+    p.add_argument("-o", "--output", required=True, help="輸出資料夾")
+    p.set_defaults(func=cmd_attendance)
+
+    p = commands.add_parser("report", help="匯出課程學期報表（學員 × 週次）")
+    add_class_arguments(p)
+    p.add_argument("--format", choices=["xlsx", "pdf"], default="xlsx")
+    p.add_argument("-o", "--output", required=True, help="輸出資料夾")
+    p.set_defaults(func=cmd_report)
+
+    p = commands.add_parser("students", help="匯出學員資料 Excel")
+    p.add_argument("-o", "--output", required=True, help="輸出檔案（.xlsx）")
+    p.set_defaults(func=cmd_students)
+
+    p = commands.add_parser("qrcodes", help="產生課程學員 QR Code")
+    add_class_arguments(p)
+    p.add_argument("-o", "--output", required=True, help="輸出資料夾，每個課程一個子資料夾")
+    p.set_defaults(func=cmd_qrcodes)
+
+    p = commands.add_parser("history", help="匯出所有課程的簽到歷史原始資料（CSV 或 JSON Lines）")
+    p.add_argument("-o", "--output", required=True, help="輸出檔案")
+    p.add_argument("--format", choices=HISTORY_FORMATS, help="未指定時依副檔名判斷（.jsonl 為 JSON Lines，其餘為 CSV）")
+    p.add_argument("--since", help="只匯出簽到或簽退時間不早於此時間的記錄（YYYY-MM-DD HH:MM:SS）")
+    p.add_argument("--state", help="增量匯出的狀態檔：讀取上次匯出的最大時間作為 --since，完成後更新")
+    p.set_defaults(func=cmd_history)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db:
+        sqlite_db.DB_FILE = args.db
+    try:
+        conn = get_conn()
+        # 與視窗程式啟動時相同，先套用尚未執行的結構更新
+        update_db(conn)
+        return args.func(conn, args)
+    except CliError as e:
+        print(f"錯誤：{e}", file=sys.stderr)
+        return 2
+    except Exception as e:
+        print(f"執行失敗：{e}", file=sys.stderr)
+        return 1
+    finally:
+        close_conn()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+import csv
+import json
+import os
+import re
+from datetime import datetime
+from functools import partial
+from unicodedata import east_asian_width
+from xml.sax.saxutils import escape
+import qrcode
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from PIL import Image, ImageDraw
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import SimpleDocTemplate, LongTable, TableStyle, Paragraph, Spacer, PageBreak
+from fonts import pdf_font_name, pil_font
+from sqlite_db import STUDENT_COLUMNS, student_custom_fields, iter_student_wide_rows, backup_code
+
+PDF_MARGIN = 50
+ATTENDANCE_HEADERS = ["姓名", "部門", "簽到時間", "簽退時間"]
+QR_CAPTION_FONT_SIZE = 20
+# 學期報表 PDF 每個表格最多放幾堂，超過時分成多個表格
+MATRIX_PDF_SESSIONS = 20
+# 學期報表 PDF 的出席標記：已簽到並簽退 / 只有簽到
+MARK_COMPLETE = "○"
+MARK_CHECKED_IN = "△"
+
+# 簽到歷史原始資料：欄位名稱即 CSV 標題與 JSON 鍵名，供後續分析使用
+HISTORY_COLUMNS = ["checkin_id", "class_id", "class_name", "session_id", "week", "date",
+                   "student_id", "student_name", "department", "check_in_time", "check_out_time", "updated_at"]
+HISTORY_FORMATS = ("csv", "jsonl")
+HISTORY_FETCH_SIZE = 1000  # 每次從游標取出的筆數
+
+class NumberedCanvas(Canvas):
+    """先保留每一頁的內容，存檔時才加上「第 x 頁 / 共 y 頁」，整份文件只需排版一次"""
+
+    def __init__(self, *args, font_name="Helvetica", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.font_name = font_name
+        self._saved_pages = []
+
+    def showPage(self):
+        self._saved_pages.append(dict(self.__dict__))
+        self._startPage()
+
+    def save(self):
+        total = len(self._saved_pages)
+        for state in self._saved_pages:
+            self.__dict__.update(state)
+            self.setFont(self.font_name, 9)
+            self.drawCentredString(self._pagesize[0] / 2, PDF_MARGIN / 2, f"第 {self._pageNumber} 頁 / 共 {total} 頁")
+            super().showPage()
+        super().save()
+
+def attendance_stats(records):
+    """依 (姓名, 部門, 簽到時間, 簽退時間) 計算應到/簽到/簽退人數"""
+    total = len(records)
+    checked_in = sum(1 for r in records if r[2])
+    checked_out = sum(1 for r in records if r[3])
+    return (f"應到: {total}  |  簽到: {checked_in}  |  未簽到: {total - checked_in}  |  "
+            f"簽退: {checked_out}  |  未簽退: {checked_in - checked_out}")
+
+def load_session_attendance(conn, class_id, session_id):
+    """回傳 (課程名稱, 堂次資訊, 出席記錄 [(姓名, 部門, 簽到, 簽退)])，供 export_attendance_pdf 使用"""
+    row = conn.execute("SELECT name FROM classes WHERE id=?", (class_id,)).fetchone()
+    class_name = row[0] if row else "(未知活動(課程))"
+
+    session_data = conn.execute("SELECT week, date, start_time, end_time FROM sessions WHERE id=?",
+                                (session_id,)).fetchone()
+    if session_data:
+        week, date, start, end = session_data
+        session_info = f"第{week}週  {date}  {start}~{end}"
+    else:
+        session_info = "(未知堂次)"
+
+    records = conn.execute("""
+        SELECT a.name, a.department, ci.check_in_time, ci.check_out_time
+        FROM students a
+        INNER JOIN class_students cs ON cs.student_id = a.id
+        LEFT JOIN checkins ci ON ci.student_id = a.id AND ci.session_id = ?
+        WHERE cs.class_id = ?
+        ORDER BY a.name
+    """, (session_id, class_id)).fetchall()
+    return class_name, session_info, records
+
+def export_attendance_pdf(file_path, org_info, class_name, session_info, records):
+    """匯出單一堂次的簽到記錄 PDF；表格自動分頁，每頁重複標題列並加上頁碼"""
+    font_name = pdf_font_name()
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    width, height = A4
+
+    def draw_page(canvas, doc):
+        canvas.saveState()
+        canvas.setFont(font_name, 10)
+        canvas.drawRightString(width - PDF_MARGIN, height - 30, f"列印日期：{now_str}")
+        canvas.restoreState()
+
+    title_style = ParagraphStyle("title", fontName=font_name, fontSize=14, leading=20)
+    info_style = ParagraphStyle("info", fontName=font_name, fontSize=12, leading=20)
+    stats_style = ParagraphStyle("stats", fontName=font_name, fontSize=11, leading=20)
+    story = [Paragraph("簽到記錄報表", title_style), Spacer(1, 20)]
+    for label, value in [("單位名稱", org_info.get("org_name", "")),
+                         ("管理人員", org_info.get("manager", "")),
+                         ("聯絡方式", org_info.get("contact", "")),
+                         ("課程名稱", class_name),
+                         ("堂次資訊", session_info)]:
+        story.append(Paragraph(escape(f"{label}：{value}"), info_style))
+    story.append(Paragraph(escape(f"統計資訊：{attendance_stats(records)}"), stats_style))
+    story.append(Spacer(1, 20))
+
+    table_data = [ATTENDANCE_HEADERS]
+    table_data += [[name, dept or "", check_in or "", check_out or ""] for name, dept, check_in, check_out in records]
+    # LongTable 分頁時不會反覆重算整張表；repeatRows=1 讓每頁都有標題列
+    table = LongTable(table_data, colWidths=[100, 100, 150, 150], repeatRows=1)
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), font_name),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ]))
+    story.append(table)
+
+    doc = SimpleDocTemplate(file_path, pagesize=A4, leftMargin=PDF_MARGIN, rightMargin=PDF_MARGIN,
+                            topMargin=PDF_MARGIN, bottomMargin=PDF_MARGIN,
+                            title="簽到記錄報表")
+    doc.build(story, onFirstPage=draw_page, onLaterPages=draw_page,
+              canvasmaker=partial(NumberedCanvas, font_name=font_name))
+
+def load_attendance_matrix(conn, class_id):
+    """以單一查詢取得整個課程的簽到記錄，轉成 學員 × 堂次 矩陣
+
+    回傳 (堂次清單 [(id, 週次, 日期)], 學員清單 [(姓名, 部門, {堂次id: (簽到, 簽退)})], 已舉行的堂次 id 集合)；
+    至少有一筆簽到的堂次才算已舉行，出席率以已舉行的堂次計算。
+    """
+    sessions = conn.execute("""
+        SELECT id, week, date FROM sessions WHERE class_id=? ORDER BY week, date, id
+    """, (class_id,)).fetchall()
+    students = {}
+    for student_id, name, dept, session_id, check_in, check_out in conn.execute("""
+        SELECT s.id, s.name, s.department, ci.session_id, ci.check_in_time, ci.check_out_time
+        FROM class_students cs
+        INNER JOIN students s ON s.id = cs.student_id
+        LEFT JOIN checkins ci ON ci.student_id = s.id
+            AND ci.session_id IN (SELECT id FROM sessions WHERE class_id = ?)
+        WHERE cs.class_id = ?
+        ORDER BY s.name, s.id
+    """, (class_id, class_id)):
+        entry = students.get(student_id)
+        if entry is None:
+            entry = students[student_id] = (name, dept or "", {})
+        if session_id is not None and check_in:
+            entry[2][session_id] = (check_in, check_out or "")
+    held = {session_id for _, _, times in students.values() for session_id in times}
+    return sessions, list(students.values()), held
+
+def attendance_rate(times, held):
+    # 回傳 (出席次數, 出席率)
+    present = len(times)
+    return present, (present / len(held) if held else 0)
+
+def session_label(week, date):
+    return f"第{week}週" + (f" {date}" if date else "")
+
+def sheet_title(name):
+    # Excel 工作表名稱不可含 / \ ? * [ ] :，且最多 31 字
+    return re.sub(r"[\\/?*\[\]:]", "_", name)[:31]
+
+def export_matrix_xlsx(file_path, class_name, matrix):
+    """匯出課程學期報表 Excel：每堂三欄（簽到、簽退、出席），最後為出席次數及出席率"""
+    sessions, students, held = matrix
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_title(class_name) or "學期報表")
+    # 唯讀/只寫模式下欄寬與凍結窗格必須在寫入資料前設定
+    ws.column_dimensions["A"].width = 12
+    ws.column_dimensions["B"].width = 12
+    for index in range(len(sessions)):
+        ws.column_dimensions[get_column_letter(3 + index * 3)].width = 19
+        ws.column_dimensions[get_column_letter(4 + index * 3)].width = 19
+        ws.column_dimensions[get_column_letter(5 + index * 3)].width = 6
+    ws.freeze_panes = "C2"
+
+    header = ["姓名", "部門"]
+    for _, week, date in sessions:
+        label = session_label(week, date)
+        header += [f"{label} 簽到", f"{label} 簽退", f"{label} 出席"]
+    ws.append(header + ["出席次數", "出席率"])
+
+    counts = {session_id: 0 for session_id, _, _ in sessions}
+    for name, dept, times in students:
+        row = [name, dept]
+        for session_id, _, _ in sessions:
+            check_in, check_out = times.get(session_id, ("", ""))
+            row += [check_in, check_out, "V" if check_in else ""]
+            if check_in:
+                counts[session_id] += 1
+        present, rate = attendance_rate(times, held)
+        rate_cell = WriteOnlyCell(ws, value=round(rate, 4))
+        rate_cell.number_format = "0%"
+        ws.append(row + [present, rate_cell])
+
+    total = ["出席人數", ""]
+    for session_id, _, _ in sessions:
+        total += ["", "", counts[session_id]]
+    ws.append(total)
+    wb.save(file_path)
+
+def export_matrix_pdf(file_path, org_info, class_name, matrix):
+    """匯出課程學期報表 PDF（A4 橫向）：每堂一欄出席標記，堂數多時分成多個表格"""
+    sessions, students, held = matrix
+    font_name = pdf_font_name()
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    width, height = landscape(A4)
+
+    def draw_page(canvas, doc):
+        canvas.saveState()
+        canvas.setFont(font_name, 10)
+        canvas.drawRightString(width - PDF_MARGIN, height - 30, f"列印日期：{now_str}")
+        canvas.restoreState()
+
+    title_style = ParagraphStyle("title", fontName=font_name, fontSize=14, leading=20)
+    info_style = ParagraphStyle("info", fontName=font_name, fontSize=11, leading=18)
+    story = [Paragraph("學期出席報表", title_style), Spacer(1, 10)]
+    for label, value in [("單位名稱", org_info.get("org_name", "")),
+                         ("課程名稱", class_name),
+                         ("統計資訊", f"學員 {len(students)} 位｜堂次 {len(sessions)} 堂（已舉行 {len(held)} 堂）"),
+                         ("標記說明", f"{MARK_COMPLETE} 簽到並簽退　{MARK_CHECKED_IN} 只有簽到　空白 未出席")]:
+        story.append(Paragraph(escape(f"{label}：{value}"), info_style))
+    story.append(Spacer(1, 10))
+
+    summaries = [attendance_rate(times, held) for _, _, times in students]
+    groups = [sessions[i:i + MATRIX_PDF_SESSIONS] for i in range(0, len(sessions), MATRIX_PDF_SESSIONS)] or [[]]
+    name_widths = [70, 60]
+    summary_widths = [35, 40]
+    mark_width = (width - 2 * PDF_MARGIN - sum(name_widths) - sum(summary_widths)) / MATRIX_PDF_SESSIONS
+    for index, group in enumerate(groups):
+        if index:
+            story.append(PageBreak())
+        table_data = [["姓名", "部門"] + [str(week) for _, week, _ in group] + ["出席", "出席率"]]
+        for (name, dept, times), (present, rate) in zip(students, summaries):
+            marks = []
+            for session_id, _, _ in group:
+                check_in, check_out = times.get(session_id, ("", ""))
+                marks.append(MARK_COMPLETE if check_out else MARK_CHECKED_IN if check_in else "")
+            table_data.append([name, dept] + marks + [present, f"{rate:.0%}"])
+        table = LongTable(table_data, colWidths=name_widths + [mark_width] * len(group) + summary_widths, repeatRows=1)
+        table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTSIZE', (0, 0), (-1, -1), 8),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ]))
+        story.append(table)
+
+    doc = SimpleDocTemplate(file_path, pagesize=landscape(A4), leftMargin=PDF_MARGIN, rightMargin=PDF_MARGIN,
+                            topMargin=PDF_MARGIN, bottomMargin=PDF_MARGIN,
+                            title="學期出席報表")
+    doc.build(story, onFirstPage=draw_page, onLaterPages=draw_page,
+              canvasmaker=partial(NumberedCanvas, font_name=font_name))
+
+def display_width(value):
+    # Excel 欄寬以半形字元計，全形（中文）字元算兩個
+    return sum(2 if east_asian_width(ch) in "WF" else 1 for ch in str(value))
+
+def export_students_xlsx(conn, file_path):
+    """以只寫模式串流匯出學員資料；先掃描一次計算欄寬，再逐列寫入，記憶體用量與學員數無關"""
+    fields = student_custom_fields(conn)
+    headers = [label for label, _ in STUDENT_COLUMNS] + [field_name for field_name, _ in fields]
+    # 只寫模式的欄寬必須在寫入第一列前設定，因此先掃描一次資料
+    widths = [display_width(header) for header in headers]
+    for _, *row in iter_student_wide_rows(conn, fields):
+        for index, value in enumerate(row):
+            if value:
+                widths[index] = max(widths[index], display_width(value))
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for index, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(index)].width = width + 2
+    ws.append(headers)
+    for _, *row in iter_student_wide_rows(conn, fields):
+        ws.append(row)
+    wb.save(file_path)
+
+def make_qrcode_image(data, caption):
+    """產生 QR Code 圖片，下方加上說明文字（姓名、備用碼）"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
+
+    width, height = qr_img.size
+    final_img = Image.new("RGB", (width, height + 80), "white")
+    final_img.paste(qr_img, (0, 0))
+
+    draw = ImageDraw.Draw(final_img)
+    font = pil_font(QR_CAPTION_FONT_SIZE)
+    bbox = draw.textbbox((0, 0), caption, font=font)
+    draw.text(((width - (bbox[2] - bbox[0])) / 2, height + 10), caption, fill="black", font=font)
+    return final_img
+
+def export_class_qrcodes(conn, class_id, folder_path):
+    """將課程所有學員的 QR Code（含備用碼）存成 姓名.png，回傳產生的張數"""
+    students = conn.execute("""
+        SELECT s.name, s.hash
+        FROM students s
+        INNER JOIN class_students cs ON cs.student_id = s.id
+        WHERE cs.class_id = ?
+    """, (class_id,)).fetchall()
+    for name, h in students:
+        img = make_qrcode_image(h, f"{name}｜備用碼：{backup_code(h)}")
+        img.save(os.path.join(folder_path, f"{name}.png"))
+    return len(students)
+
+def iter_checkin_history(conn, since=None, fetch_size=HISTORY_FETCH_SIZE):
+    """逐筆產生所有課程的簽到記錄（欄位順序同 HISTORY_COLUMNS），以 fetchmany 分批讀取
+
+    updated_at 為簽到、簽退時間中較晚者；指定 since 時只回傳 updated_at >= since 的記錄。
+    包含等於 since 的記錄，避免同一秒內稍後寫入的記錄被漏掉，重複的記錄可依 checkin_id 去除。
+    完整匯出依 checkins.id 順序讀取，不需排序，記憶體用量與記錄筆數無關；
+    增量匯出直接以簽到、簽退時間篩選，走兩個時間索引，只讀取新記錄。
+    """
+    sql = """
+        SELECT ci.id, se.class_id, c.name, ci.session_id, se.week, se.date,
+               ci.student_id, s.name, s.department, ci.check_in_time, ci.check_out_time,
+               MAX(COALESCE(ci.check_in_time, ''), COALESCE(ci.check_out_time, '')) AS updated_at
+        FROM checkins ci
+        LEFT JOIN sessions se ON se.id = ci.session_id
+        LEFT JOIN classes c ON c.id = se.class_id
+        LEFT JOIN students s ON s.id = ci.student_id
+    """
+    params = ()
+    if since:
+        # 與 updated_at >= since 相同；寫成兩個索引查詢的聯集，直接寫 OR 加上 ORDER BY 時會改為掃描整個表
+        sql += """
+        WHERE ci.id IN (
+            SELECT id FROM checkins WHERE check_in_time >= ?
+            UNION
+            SELECT id FROM checkins WHERE check_out_time >= ?
+        )"""
+        params = (since, since)
+    cursor = conn.execute(sql + " ORDER BY ci.id", params)
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+def export_checkin_history(conn, file_path, fmt="csv", since=None):
+    """匯出簽到歷史為 CSV（UTF-8 BOM）或 JSON Lines，回傳 (筆數, 最大的 updated_at)
+
+    回傳的 updated_at 可作為下一次增量匯出的 since；沒有資料時為 None。
+    """
+    if fmt not in HISTORY_FORMATS:
+        raise ValueError(f"不支援的格式：{fmt}")
+    count = 0
+    high_water = None
+    updated_index = HISTORY_COLUMNS.index("updated_at")
+    with open(file_path, "w", newline="", encoding="utf-8-sig" if fmt == "csv" else "utf-8") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(HISTORY_COLUMNS)
+        for row in iter_checkin_history(conn, since):
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(HISTORY_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += 1
+            updated = row[updated_index]
+            if updated and (high_water is None or updated > high_water):
+                high_water = updated
+    return count, high_water
@@ -0,0 +1,116 @@
+import os
+import platform
+import shutil
+import subprocess
+import threading
+from PIL import ImageFont
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfbase.ttfonts import TTFont, TTFError
+
+# 可用環境變數指定字型檔（.ttf/.ttc/.otf），優先於系統字型
+FONT_ENV = "CHECKIN_FONT"
+
+# 依序尋找的中文字型 (路徑, ttc 子字型索引)
+FONT_CANDIDATES = {
+    "Windows": [
+        (os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "msjh.ttc"), 0),
+        (os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "msjh.ttf"), 0),
+        (os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "mingliu.ttc"), 0),
+    ],
+    "Linux": [
+        ("/usr/share/fonts/truetype/wqy/wqy-microhei.ttc", 0),
+        ("/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc", 0),
+        ("/usr/share/fonts/truetype/arphic/uming.ttc", 0),
+        ("/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf", 0),
+        ("/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc", 3),  # 3 = 繁體中文 (TC)
+        ("/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc", 3),
+        ("/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc", 3),
+    ],
+    "Darwin": [
+        ("/System/Library/Fonts/PingFang.ttc", 0),
+        ("/Library/Fonts/Arial Unicode.ttf", 0),
+    ],
+}
+
+PDF_FONT_NAME = "CheckinCJK"
+# 找不到可嵌入的字型檔時使用 reportlab 內建的繁體中文 CID 字型（不嵌入，由閱讀器提供字形）
+PDF_FALLBACK_FONT = "MSung-Light"
+
+_lock = threading.Lock()
+_font_file = None
+_pdf_font = None
+_pil_fonts = {}
+
+def _fc_list_font():
+    # Linux 上以 fontconfig 找出支援繁體中文的字型
+    if not shutil.which("fc-list"):
+        return None
+    try:
+        output = subprocess.run(["fc-list", ":lang=zh-tw", "--format", "%{file}|%{index}\n"],
+                                capture_output=True, text=True, timeout=5).stdout
+    except Exception:
+        return None
+    fonts = []
+    for line in output.splitlines():
+        path, _, index = line.partition("|")
+        if path:
+            fonts.append((path, int(index or 0)))
+    # TrueType 輪廓的字型 reportlab 可以嵌入，優先使用
+    fonts.sort(key=lambda font: not font[0].lower().endswith((".ttf", ".ttc")))
+    return fonts[0] if fonts else None
+
+def find_font_file():
+    """回傳 (字型檔路徑, 子字型索引)，找不到時回傳 None；結果在程式執行期間保留"""
+    global _font_file
+    with _lock:
+        if _font_file is None:
+            _font_file = (None, 0)
+            configured = os.environ.get(FONT_ENV)
+            candidates = [(configured, 0)] if configured else []
+            candidates += FONT_CANDIDATES.get(platform.system(), [])
+            for path, index in candidates:
+                if os.path.exists(path):
+                    _font_file = (path, index)
+                    break
+            else:
+                _font_file = _fc_list_font() or (None, 0)
+        return _font_file if _font_file[0] else None
+
+def pdf_font_name():
+    """註冊 PDF 用的中文字型並回傳字型名稱；只在第一次呼叫時讀取字型檔"""
+    global _pdf_font
+    font_file = find_font_file()
+    with _lock:
+        if _pdf_font is None:
+            _pdf_font = PDF_FALLBACK_FONT
+            if font_file:
+                try:
+                    pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, font_file[0], subfontIndex=font_file[1]))
+                    _pdf_font = PDF_FONT_NAME
+                except TTFError:
+                    # 例如 Noto CJK 的 PostScript (CFF) 輪廓，reportlab 無法嵌入
+                    pass
+            if _pdf_font == PDF_FALLBACK_FONT:
+                pdfmetrics.registerFont(UnicodeCIDFont(PDF_FALLBACK_FONT))
+        return _pdf_font
+
+def pil_font(size):
+    """取得圖片用的中文字型（依大小快取）；找不到字型檔時使用 PIL 內建字型"""
+    font_file = find_font_file()
+    with _lock:
+        font = _pil_fonts.get(size)
+        if font is None:
+            if font_file:
+                try:
+                    font = ImageFont.truetype(font_file[0], size, index=font_file[1])
+                except OSError:
+                    pass
+            if font is None:
+                try:
+                    font = ImageFont.load_default(size)
+                except TypeError:
+                    # Pillow 10.1 以前的 load_default 不接受大小
+                    font = ImageFont.load_default()
+            _pil_fonts[size] = font
+        return font
@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import MemoryHandler, RotatingFileHandler
+
+# 匯入記錄：每行一筆 JSON，依大小輪替，保留歷次匯入
+IMPORT_LOG_FILE = "import_log.jsonl"
+IMPORT_LOG_MAX_BYTES = 1024 * 1024
+IMPORT_LOG_BACKUPS = 5
+IMPORT_LOG_BUFFER = 200  # 累積筆數達到此數量（或出現錯誤）才寫入檔案
+
+_logger = logging.getLogger("import_log")
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S"),
+                 "level": record.levelname}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False)
+
+def _get_logger():
+    # 第一次使用時才建立檔案 handler，並以 MemoryHandler 緩衝
+    if not _logger.handlers:
+        file_handler = RotatingFileHandler(IMPORT_LOG_FILE, maxBytes=IMPORT_LOG_MAX_BYTES,
+                                           backupCount=IMPORT_LOG_BACKUPS, encoding="utf-8", delay=True)
+        file_handler.setFormatter(JsonLineFormatter())
+        _logger.addHandler(MemoryHandler(IMPORT_LOG_BUFFER, flushLevel=logging.ERROR, target=file_handler))
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+    return _logger
+
+def flush_import_log():
+    for handler in _logger.handlers:
+        handler.flush()
+
+class ImportRun:
+    """一次匯入的結構化記錄：每筆都帶有 run_id，結束時記錄各階段耗時與筆數並寫入檔案"""
+
+    def __init__(self, kind, file_path):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.log("start", kind=kind, file=file_path)
+
+    def log(self, event, level=logging.INFO, **fields):
+        fields = dict(run_id=self.run_id, event=event, **fields)
+        _get_logger().log(level, event, extra={"fields": fields})
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - start) * 1000, 1)
+            self.log("phase", phase=name, elapsed_ms=self.phases[name])
+
+    def finish(self, status, **counts):
+        level = logging.ERROR if status == "error" else logging.INFO
+        self.log("finish", level=level, status=status, phases_ms=self.phases,
+                 elapsed_ms=round((time.perf_counter() - self.started) * 1000, 1), **counts)
+        flush_import_log()
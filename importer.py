@@ -0,0 +1,475 @@
+import codecs
+import csv
+from openpyxl import load_workbook
+from sqlite_db import hash_name, STUDENT_COLUMNS, student_custom_fields, iter_student_wide_rows
+
+# students 表本身除姓名外的欄位（匯入檔標題 -> 資料表欄位），不寫入 student_custom_values
+BASIC_COLUMNS = STUDENT_COLUMNS[1:]
+
+# 每批寫入的列數，控制 executemany 參數清單的大小
+CHUNK_SIZE = 500
+
+# CSV 編碼偵測：讀取檔案開頭的位元組數，以及沒有 BOM 時依序嘗試的編碼
+SNIFF_SIZE = 64 * 1024
+CSV_ENCODINGS = ["utf-8", "cp950", "big5"]
+
+# 重複學員的處理方式
+SKIP = "skip"
+OVERWRITE = "overwrite"
+MERGE = "merge"
+DUPLICATE_ACTIONS = {SKIP: "跳過", OVERWRITE: "覆蓋", MERGE: "合併"}
+
+# 匯入檢查結果的等級：有錯誤時不匯入；警告為已自動更正的資料
+ERROR = "錯誤"
+WARNING = "警告"
+REPORT_HEADERS = ["列號", "姓名", "欄位", "內容", "等級", "說明"]
+
+# 匯入進度回報的階段
+PHASE_CHECK = "check"
+PHASE_STAGE = "stage"
+PHASE_APPLY = "apply"
+IMPORT_PHASES = {PHASE_CHECK: "檢查資料並比對重複學員", PHASE_STAGE: "讀取匯入資料", PHASE_APPLY: "寫入資料庫"}
+
+class ImportCancelled(Exception):
+    """使用者取消匯入"""
+
+def cell(row, field):
+    # 取出欄位值並去除空白；csv 短少欄位時值為 None
+    value = row.get(field)
+    return str(value).strip() if value is not None else ""
+
+def chunked(iterable, size=CHUNK_SIZE):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_xlsx_rows(file_path):
+    """以唯讀模式逐列讀取工作表，第一列為標題，逐筆產生 {標題: 值}"""
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        values = wb.active.iter_rows(values_only=True)
+        headers = next(values, None)
+        if headers is None:
+            return
+        headers = [str(h).strip() if h is not None else "" for h in headers]
+        for row in values:
+            if all(v is None for v in row):
+                continue
+            yield {h: (str(v).strip() if v is not None else "") for h, v in zip(headers, row) if h}
+    finally:
+        wb.close()
+
+def detect_encoding(file_path):
+    """依檔案開頭判斷 CSV 編碼：有 BOM 依 BOM，否則依序嘗試 CSV_ENCODINGS"""
+    with open(file_path, "rb") as f:
+        sample = f.read(SNIFF_SIZE)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    for encoding in CSV_ENCODINGS:
+        try:
+            # 增量解碼：樣本結尾被截斷的多位元組字元不視為錯誤
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("無法判斷 CSV 檔案編碼，請另存為 UTF-8 後再匯入")
+
+def iter_csv_rows(file_path, encoding=None):
+    """逐列讀取 CSV，第一列為標題，逐筆產生 {標題: 值}；未指定編碼時自動偵測"""
+    with open(file_path, newline="", encoding=encoding or detect_encoding(file_path)) as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames:
+            reader.fieldnames = [h.strip() for h in reader.fieldnames]
+        yield from reader
+
+class ImportValidator:
+    """匯入前檢查：必填欄位、選項欄位及檔案內重複的姓名，不寫入資料庫
+
+    check() 逐列檢查並產生更正後的資料列，可直接串接到 find_conflicts，
+    與比對重複學員在同一次讀檔內完成；選項值若只是某個選項的開頭
+    （例如「葷」->「葷食」）視為警告並自動更正，其餘不符的值為錯誤。
+    """
+
+    def __init__(self, conn):
+        # 同名欄位只取第一個，與匯入及學員編輯畫面一致
+        self.required = []
+        field_ids = {}
+        for field_id, field_name, field_type, is_required in conn.execute("""
+            SELECT id, field_name, field_type, is_required
+            FROM custom_fields
+            ORDER BY display_order, id
+        """):
+            if field_name in field_ids:
+                continue
+            field_ids[field_name] = (field_id, field_type)
+            if is_required:
+                self.required.append(field_name)
+
+        options_by_id = {}
+        for field_id, option in conn.execute("SELECT field_id, option_value FROM field_options ORDER BY field_id, display_order"):
+            options = options_by_id.setdefault(field_id, [])
+            if option not in options:
+                options.append(option)
+        # 只檢查有設定選項的選項欄位
+        self.options = {name: options_by_id[field_id] for name, (field_id, field_type) in field_ids.items()
+                        if field_type == "select" and options_by_id.get(field_id)}
+        self.matches = {name: {option: option for option in options} for name, options in self.options.items()}
+
+        self.issues = []
+        self.errors = 0
+        self.warnings = 0
+        self.rows = 0
+        self.names = {}  # 姓名 -> 第一次出現的列號
+
+    def check(self, rows):
+        """逐列檢查並產生更正後的資料列；列號從 2 起算（第 1 列為標題）"""
+        header_checked = False
+        for line, row in enumerate(rows, 2):
+            if not header_checked:
+                header_checked = True
+                for field in ["姓名"] + self.required:
+                    if field not in row:
+                        self._add(1, "", field, "", ERROR, "缺少必填欄位")
+            if not any(cell(row, field) for field in row if field):
+                continue
+            self.rows += 1
+            name = cell(row, "姓名")
+            if not name:
+                self._add(line, "", "姓名", "", ERROR, "姓名不能為空")
+            elif name in self.names:
+                self._add(line, name, "姓名", name, ERROR, f"與第 {self.names[name]} 列姓名重複")
+            else:
+                self.names[name] = line
+
+            for field in self.required:
+                if field in row and not cell(row, field):
+                    self._add(line, name, field, "", ERROR, "必填欄位未填寫")
+
+            corrected = None
+            for field, options in self.options.items():
+                value = cell(row, field)
+                if not value:
+                    continue
+                option = self._match(field, value)
+                if option is None:
+                    self._add(line, name, field, value, ERROR, f"不是有效的選項（{'/'.join(options)}）")
+                elif option != value:
+                    self._add(line, name, field, value, WARNING, f"將以「{option}」匯入")
+                    corrected = corrected or dict(row)
+                    corrected[field] = option
+            yield corrected or row
+
+    def normalize(self, rows):
+        """只套用選項更正，不記錄檢查結果（檢查通過後實際匯入時使用）"""
+        for row in rows:
+            corrected = None
+            for field in self.options:
+                value = cell(row, field)
+                option = self._match(field, value) if value else None
+                if option is not None and option != value:
+                    corrected = corrected or dict(row)
+                    corrected[field] = option
+            yield corrected or row
+
+    def _match(self, field, value):
+        # 完全相符或唯一的開頭相符才接受；結果快取，同一個值只比對一次
+        matches = self.matches[field]
+        if value not in matches:
+            candidates = [option for option in self.options[field] if option.startswith(value)]
+            matches[value] = candidates[0] if len(candidates) == 1 else None
+        return matches[value]
+
+    def _add(self, line, name, field, value, level, message):
+        self.issues.append((line, name, field, value, level, message))
+        if level == ERROR:
+            self.errors += 1
+        else:
+            self.warnings += 1
+
+    def write_report(self, file_path):
+        """將檢查結果寫成 CSV（UTF-8 BOM，可直接以 Excel 開啟）"""
+        with open(file_path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_HEADERS)
+            writer.writerows(sorted(self.issues, key=lambda issue: issue[0]))
+
+class StudentImporter:
+    """學員批次匯入
+
+    先一次載入既有的 姓名 -> id 對照，將每批資料分成新增與既有兩組，
+    以 executemany 暫存至 TEMP 資料表，讀完後再以單一交易寫入正式資料表。
+    暫存期間不佔用資料庫寫入鎖，簽到寫入只會在最後寫入時短暫等待。
+
+    progress(階段, 計數) 於每批處理後呼叫；cancel_event 被設定時
+    在下一批之前拋出 ImportCancelled，資料庫不會有任何變更。
+    """
+
+    def __init__(self, conn, progress=None, cancel_event=None):
+        self.conn = conn
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.fields = student_custom_fields(conn)
+        # 同名欄位（舊版 init_db 重複建立）寫入時只用第一個，與學員編輯畫面一致
+        self.value_fields = [(field_ids[0], field_name) for field_name, field_ids in self.fields]
+        self.existing = dict(conn.execute("SELECT name, id FROM students"))
+        self.existing_values = {}  # 重複學員的現有資料：姓名 -> {欄位: 值}
+        self.new_names = set()  # 已暫存的新學員姓名
+        self.read = 0
+        self.added = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def find_conflicts(self, rows):
+        """比對檔案與資料庫中的重複學員，回傳有欄位差異者的清單
+
+        每筆為 {"name", "student_id", "diffs": [(欄位, 現有值, 匯入值), ...]}；
+        資料完全相同的重複學員不列入，匯入時直接跳過。
+        rows 可以是產生器，逐批比對，只保留有差異學員的資料。
+        """
+        conflicts = []
+        seen = set()
+        self.read = 0
+        for chunk in chunked(rows):
+            self._check_cancel()
+            self.read += len(chunk)
+            duplicate_rows = {}
+            for row in chunk:
+                name = cell(row, "姓名")
+                if name in self.existing and name not in seen:
+                    seen.add(name)
+                    duplicate_rows[name] = row
+            self._load_existing_values(list(duplicate_rows))
+
+            for name, row in duplicate_rows.items():
+                old = self.existing_values[name]
+                diffs = []
+                for field in self._row_fields(row):
+                    new = cell(row, field)
+                    if new != old.get(field, ""):
+                        diffs.append((field, old.get(field, ""), new))
+                if diffs:
+                    conflicts.append({"name": name, "student_id": self.existing[name], "diffs": diffs})
+                else:
+                    del self.existing_values[name]
+            self._report(PHASE_CHECK)
+        return conflicts
+
+    def import_rows(self, rows, decisions=None):
+        """匯入資料列並提交；decisions 為 姓名 -> SKIP/OVERWRITE/MERGE，未列出的重複學員一律跳過
+
+        覆蓋與合併以重複學員的現有資料為基礎；find_conflicts 已載入的直接使用，
+        其餘於每批暫存前自行載入，因此不必先呼叫 find_conflicts。
+        """
+        decisions = dict(decisions or {})
+        self.read = 0
+        self._create_staging()
+        try:
+            for chunk in chunked(rows):
+                self._check_cancel()
+                self.read += len(chunk)
+                self._stage_chunk(chunk, decisions)
+                self._report(PHASE_STAGE)
+            # 先結束暫存的交易，再以 BEGIN IMMEDIATE 取得寫入鎖
+            self.conn.commit()
+            self._check_cancel()
+            self._report(PHASE_APPLY)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._apply_staging()
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        finally:
+            self._drop_staging()
+        return {"added": self.added, "updated": self.updated, "skipped": self.skipped}
+
+    def _check_cancel(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise ImportCancelled()
+
+    def _report(self, phase):
+        if self.progress:
+            self.progress(phase, {"read": self.read, "added": self.added,
+                                  "updated": self.updated, "skipped": self.skipped})
+
+    def _stage_chunk(self, chunk, decisions):
+        # 要覆蓋或合併、但尚未載入現有資料的重複學員（例如未先呼叫 find_conflicts）
+        missing = {}
+        for row in chunk:
+            name = cell(row, "姓名")
+            if name in self.existing and name not in self.existing_values and decisions.get(name) in (OVERWRITE, MERGE):
+                missing[name] = None
+        self._load_existing_values(list(missing))
+
+        new_rows = {}
+        existing_rows = []
+        for row in chunk:
+            name = cell(row, "姓名")
+            if not name:
+                continue
+            student_id = self.existing.get(name)
+            if student_id is not None:
+                action = decisions.pop(name, SKIP)
+                resolved = self._resolve(name, row, action) if action in (OVERWRITE, MERGE) else None
+                if resolved is not None and self._changed(name, resolved):
+                    existing_rows.append((student_id, resolved))
+                else:
+                    self.skipped += 1
+            elif name in self.new_names or name in new_rows:
+                # 同一檔案內重複的姓名只新增第一筆
+                self.skipped += 1
+            else:
+                new_rows[name] = row
+
+        # 新學員只暫存有值的欄位；既有學員連同空白值一起暫存，寫入時刪除被清空的值
+        staged = [(name, None, row) for name, row in new_rows.items()]
+        staged += [(None, student_id, row) for student_id, row in existing_rows]
+        if not staged:
+            return
+        first = self.staged_rows + 1
+        self.staged_rows += len(staged)
+        c = self.conn.cursor()
+        c.executemany("""
+            INSERT INTO temp.import_students (row_id, name, hash, student_id, department, gender, phone, dietary)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(row_id, name, hash_name(name) if name else None, student_id)
+              + tuple(cell(row, label) for label, _ in BASIC_COLUMNS)
+              for row_id, (name, student_id, row) in enumerate(staged, first)])
+        c.executemany("""
+            INSERT INTO temp.import_values (row_id, field_id, field_value)
+            VALUES (?, ?, ?)
+        """, [value for row_id, (name, _, row) in enumerate(staged, first)
+              for value in self._custom_values(row_id, row, keep_blank=name is None)])
+
+        self.new_names.update(new_rows)
+        self.added += len(new_rows)
+        self.updated += len(existing_rows)
+
+    def _changed(self, name, resolved):
+        # 處理後的資料與現有資料相同時不需寫入
+        old = self.existing_values.get(name, {})
+        return any(value != old.get(field, "") for field, value in resolved.items())
+
+    def _row_fields(self, row):
+        # 匯入檔中有出現、且會寫入資料庫的欄位
+        fields = [label for label, _ in BASIC_COLUMNS] + [name for _, name in self.value_fields]
+        return [field for field in fields if field in row]
+
+    def _resolve(self, name, row, action):
+        # 覆蓋：檔案中有的欄位一律採用匯入值；合併：只補上現有資料空白的欄位
+        # 檔案中沒有的欄位保留現有資料
+        resolved = dict(self.existing_values.get(name, {}))
+        for field in self._row_fields(row):
+            if action == OVERWRITE or not resolved.get(field):
+                resolved[field] = cell(row, field)
+        return resolved
+
+    def _load_existing_values(self, names):
+        labels = [label for label, _ in BASIC_COLUMNS] + [field_name for field_name, _ in self.fields]
+        for chunk in chunked(names):
+            id_to_name = {self.existing[name]: name for name in chunk}
+            placeholders = ",".join("?" * len(id_to_name))
+            for sid, _, *values in iter_student_wide_rows(self.conn, self.fields, where=f"WHERE s.id IN ({placeholders})",
+                                                          params=list(id_to_name), order_by="s.id"):
+                self.existing_values[id_to_name[sid]] = {label: value or "" for label, value in zip(labels, values)}
+
+    def _create_staging(self):
+        self.conn.execute("DROP TABLE IF EXISTS temp.import_students")
+        self.conn.execute("DROP TABLE IF EXISTS temp.import_values")
+        # 共用連線的 temp_store=MEMORY 會讓暫存資料全部留在記憶體，匯入期間改存暫存檔，
+        # 記憶體用量不隨檔案大小增加；結束時還原（變更 temp_store 會清除既有的 TEMP 資料表）
+        self.temp_store = self.conn.execute("PRAGMA temp_store").fetchone()[0]
+        self.conn.execute("PRAGMA temp_store=FILE")
+        # student_id：既有學員為其 id，新學員於寫入後才填入
+        self.conn.execute("""
+            CREATE TEMP TABLE import_students (
+                row_id INTEGER PRIMARY KEY,
+                name TEXT,
+                hash TEXT,
+                student_id INTEGER,
+                department TEXT,
+                gender TEXT,
+                phone TEXT,
+                dietary TEXT
+            )""")
+        # 寫入既有學員時依 student_id 對應 students.id，沒有索引時每位學員都要掃描整個暫存表
+        self.conn.execute("CREATE INDEX temp.import_students_sid ON import_students(student_id)")
+        self.conn.execute("""
+            CREATE TEMP TABLE import_values (
+                row_id INTEGER,
+                field_id INTEGER,
+                field_value TEXT
+            )""")
+        self.staged_rows = 0
+
+    def _drop_staging(self):
+        # 暫存失敗或取消時先結束未提交的交易
+        self.conn.rollback()
+        self.conn.execute("DROP TABLE IF EXISTS temp.import_students")
+        self.conn.execute("DROP TABLE IF EXISTS temp.import_values")
+        self.conn.execute(f"PRAGMA temp_store={self.temp_store}")
+
+    def _apply_staging(self):
+        c = self.conn.cursor()
+        # 既有學員：只更新內容有變動的基本資料
+        # 有變動的 id 以非相關子查詢一次算出，SET 再依 student_id 索引取值
+        c.execute("""
+            UPDATE students SET (department, gender, phone, dietary) = (
+                SELECT department, gender, phone, dietary
+                FROM temp.import_students s WHERE s.student_id = students.id
+            )
+            WHERE id IN (
+                SELECT s.student_id
+                FROM temp.import_students s JOIN students t ON t.id = s.student_id
+                WHERE (s.department, s.gender, s.phone, s.dietary) IS NOT (t.department, t.gender, t.phone, t.dietary)
+            )
+        """)
+
+        # 新學員：寫入後以姓名取回 id；AUTOINCREMENT 保證新列的 id 大於寫入前的最大值
+        last_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM students").fetchone()[0]
+        c.execute("""
+            INSERT INTO students (name, hash, department, gender, phone, dietary)
+            SELECT name, hash, department, gender, phone, dietary
+            FROM temp.import_students WHERE name IS NOT NULL
+            ORDER BY row_id
+        """)
+        c.execute("""
+            UPDATE temp.import_students SET student_id = (
+                SELECT id FROM students WHERE students.name = import_students.name AND students.id > ?
+            )
+            WHERE name IS NOT NULL
+        """, (last_id,))
+
+        # 自定義欄位值以唯一索引 UPSERT，內容相同的值不寫入；被清空的值刪除
+        c.execute("""
+            INSERT INTO student_custom_values (student_id, field_id, field_value)
+            SELECT s.student_id, v.field_id, v.field_value
+            FROM temp.import_values v JOIN temp.import_students s ON s.row_id = v.row_id
+            WHERE v.field_value <> ''
+            ON CONFLICT(student_id, field_id) DO UPDATE SET field_value = excluded.field_value
+            WHERE field_value IS NOT excluded.field_value
+        """)
+        c.execute("""
+            DELETE FROM student_custom_values
+            WHERE (student_id, field_id) IN (
+                SELECT s.student_id, v.field_id
+                FROM temp.import_values v JOIN temp.import_students s ON s.row_id = v.row_id
+                WHERE v.field_value = ''
+            )
+        """)
+
+    def _custom_values(self, row_id, row, keep_blank=False):
+        values = []
+        for field_id, field_name in self.value_fields:
+            value = cell(row, field_name)
+            if value or keep_blank:
+                values.append((row_id, field_id, value))
+        return values
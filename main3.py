@@ -1,38 +1,50 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, simpledialog
 import sqlite3
-import csv
 import hashlib
-import qrcode
 import os
 import sys
 from datetime import datetime
-from PIL import Image, ImageTk
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen.canvas import Canvas
-from reportlab.platypus import TableStyle, Table
+from PIL import ImageTk
 from tkcalendar import DateEntry
 import platform
 import winsound
 import json
+import queue
+from collections import deque
+import threading
+import time
 import pyttsx3
-from openpyxl import Workbook, load_workbook
+from sqlite_db import (get_conn, close_conn, hash_name, backup_code, toggle_checkin, save_custom_values,
+                       student_custom_fields, iter_student_wide_rows, STUDENT_COLUMNS, CHECKED_IN, CHECKED_OUT)
+from update_db import update_db
+from scan_metrics import ScanMetrics
+from import_log import ImportRun
+from exporter import (load_session_attendance, export_attendance_pdf, load_attendance_matrix, export_matrix_xlsx,
+                      export_matrix_pdf, export_students_xlsx, export_class_qrcodes)
+from importer import (StudentImporter, ImportValidator, ImportCancelled, iter_xlsx_rows, iter_csv_rows, detect_encoding,
+                      DUPLICATE_ACTIONS, SKIP, IMPORT_PHASES, PHASE_CHECK)
 
-DB_FILE = "checkin.db"
 QR_FOLDER = "qrcodes"
-QR_SEED = "secure_seed_2024"
+# 掃描批次寫入：掃描先進入佇列，最多延遲 SCAN_FLUSH_MS 毫秒或累積 SCAN_BATCH_SIZE 筆即寫入資料庫
+# 程式異常結束時最多遺失 SCAN_FLUSH_MS 毫秒內的掃描
+SCAN_FLUSH_MS = 30
+SCAN_BATCH_SIZE = 50
+# 寫入失敗（例如資料庫被匯入或其他工作站鎖定）時，整批放回佇列重試，間隔逐次加倍至上限
+SCAN_RETRY_MAX_MS = 5000
+
+# 掃描耗時統計：狀態列顯示的階段及名稱，以及寫入記錄檔的間隔
+METRICS_READOUT_STAGES = ["lookup", "write", "row", "popup", "tts", "scan_total"]
+METRICS_STAGE_LABELS = {"lookup": "查詢", "write": "寫入", "row": "列表", "stats": "統計",
+                        "popup": "視窗", "tts": "語音", "scan_total": "總計"}
+METRICS_LOG_INTERVAL_MS = 60000
 
 if not os.path.exists(QR_FOLDER):
     os.makedirs(QR_FOLDER)
 
-def hash_name(name):
-    return hashlib.sha256(f"{name}{QR_SEED}".encode()).hexdigest()
 
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_conn() as conn:
         c = conn.cursor()
         c.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -162,8 +174,68 @@ def init_db():
         """)
         # 刪除性別欄位重複選項，只保留「男」「女」「其他」
         c.execute("DELETE FROM field_options WHERE field_id=1 AND option_value NOT IN ('男','女','其他')")
+        # 備用碼（hash 前 10 碼）查詢索引
+        c.execute("CREATE INDEX IF NOT EXISTS idx_students_backup_code ON students(substr(hash, 1, 10))")
     conn.commit()
 
+class TTSAnnouncer:
+    # 語音播報放在背景執行緒，避免 runAndWait 卡住主執行緒的掃描輸入
+    def __init__(self, rate=160, max_pending=3, max_age=5, metrics=None):
+        self.rate = rate
+        self.metrics = metrics
+        self.max_age = max_age  # 排隊超過此秒數的訊息視為過時，不再播報
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def say(self, message):
+        self._put((time.monotonic(), message))
+
+    def stop(self):
+        self._put(None)
+
+    def _put(self, item):
+        # 佇列已滿時丟棄最舊的訊息，讓最新的播報優先
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        if platform.system() == "Windows":
+            try:
+                import comtypes
+                comtypes.CoInitialize()  # SAPI5 需要在使用的執行緒初始化 COM
+            except Exception:
+                pass
+        try:
+            engine = pyttsx3.init()
+            engine.setProperty("rate", self.rate)
+        except Exception as e:
+            print(f"TTS 初始化失敗：{e}")
+            engine = None
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            queued_at, message = item
+            if engine is None or time.monotonic() - queued_at > self.max_age:
+                continue
+            started = time.perf_counter()
+            try:
+                engine.say(message)
+                engine.runAndWait()
+                if self.metrics:
+                    self.metrics.record("tts", (time.perf_counter() - started) * 1000)
+            except Exception as e:
+                print(f"TTS 撥放失敗：{e}")
+
 class ManageAttendeesDialog(tk.Toplevel):
     def __init__(self, parent, class_id, refresh_callback):
         super().__init__(parent)
@@ -203,7 +275,7 @@ class ManageAttendeesDialog(tk.Toplevel):
         for row in self.tree.get_children():
             self.tree.delete(row)
         
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             # 取得所有學員
             c.execute("""
@@ -233,7 +305,7 @@ class ManageAttendeesDialog(tk.Toplevel):
             messagebox.showwarning("警告", "請選擇要新增的學員")
             return
         
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             added = 0
             for sid in selected:
@@ -257,7 +329,7 @@ class ManageAttendeesDialog(tk.Toplevel):
             return
         
         if messagebox.askyesno("確認", f"確定要移除選取的 {len(selected)} 位學員嗎？"):
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_conn() as conn:
                 c = conn.cursor()
                 for sid in selected:
                     c.execute("DELETE FROM class_students WHERE class_id=? AND student_id=?",
@@ -266,6 +338,241 @@ class ManageAttendeesDialog(tk.Toplevel):
             self.load_students()
             self.refresh_callback()
 
+class DuplicatePreviewDialog(tk.Toplevel):
+    # 匯入前一次列出所有重複學員的欄位差異，逐筆或全部選擇處理方式
+    def __init__(self, parent, conflicts):
+        super().__init__(parent)
+        self.title("重複學員預覽")
+        self.geometry("800x500")
+        self.transient(parent)
+        self.result = None  # 確定後為 姓名 -> 處理方式，取消則為 None
+        self.actions = {conflict["name"]: SKIP for conflict in conflicts}
+        self.sort_reverse = {}
+
+        ttk.Label(self, text=f"共 {len(conflicts)} 位重複學員與現有資料不同，請選擇處理方式（合併＝只補上現有資料空白的欄位）").pack(anchor="w", padx=10, pady=5)
+
+        tree_frame = ttk.Frame(self)
+        tree_frame.pack(expand=True, fill=tk.BOTH, padx=10, pady=5)
+        columns = ("name", "field", "old", "new", "action")
+        self.tree = ttk.Treeview(tree_frame, columns=columns, show="headings")
+        for col, text in zip(columns, ("姓名", "欄位", "現有資料", "匯入資料", "處理方式")):
+            self.tree.heading(col, text=text, command=lambda c=col: self.sort_by(c))
+        self.tree.column("name", width=100)
+        self.tree.column("field", width=100)
+        self.tree.column("action", width=80)
+        self.tree.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        yscroll = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
+        yscroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.configure(yscrollcommand=yscroll.set)
+
+        self.rows_by_name = {}
+        for conflict in conflicts:
+            name = conflict["name"]
+            for field, old, new in conflict["diffs"]:
+                iid = self.tree.insert("", tk.END, values=(name, field, old, new, DUPLICATE_ACTIONS[SKIP]))
+                self.rows_by_name.setdefault(name, []).append(iid)
+
+        row_frame = ttk.Frame(self)
+        row_frame.pack(pady=2)
+        ttk.Label(row_frame, text="選取學員：").pack(side=tk.LEFT)
+        all_frame = ttk.Frame(self)
+        all_frame.pack(pady=2)
+        ttk.Label(all_frame, text="全部學員：").pack(side=tk.LEFT)
+        for action, text in DUPLICATE_ACTIONS.items():
+            ttk.Button(row_frame, text=text, command=lambda a=action: self.set_action(a, self.selected_names())).pack(side=tk.LEFT, padx=5)
+            ttk.Button(all_frame, text=f"全部{text}", command=lambda a=action: self.set_action(a, list(self.actions))).pack(side=tk.LEFT, padx=5)
+
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(pady=10)
+        ttk.Button(btn_frame, text="確定匯入", command=self.confirm).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="取消匯入", command=self.destroy).pack(side=tk.LEFT, padx=5)
+
+        self.grab_set()
+
+    def selected_names(self):
+        return {self.tree.set(iid, "name") for iid in self.tree.selection()}
+
+    def set_action(self, action, names):
+        if not names:
+            messagebox.showwarning("警告", "請先選擇學員", parent=self)
+            return
+        text = DUPLICATE_ACTIONS[action]
+        for name in names:
+            self.actions[name] = action
+            for iid in self.rows_by_name[name]:
+                self.tree.set(iid, "action", text)
+
+    def sort_by(self, col):
+        reverse = self.sort_reverse.get(col, False)
+        items = sorted(self.tree.get_children(), key=lambda iid: str(self.tree.set(iid, col)), reverse=reverse)
+        for index, iid in enumerate(items):
+            self.tree.move(iid, "", index)
+        self.sort_reverse[col] = not reverse
+
+    def confirm(self):
+        self.result = dict(self.actions)
+        self.destroy()
+
+def resolve_duplicates(parent, conflicts):
+    # 顯示重複學員預覽並等待使用者決定；回傳 姓名 -> 處理方式，取消時回傳 None
+    if not conflicts:
+        return {}
+    dialog = DuplicatePreviewDialog(parent, conflicts)
+    parent.wait_window(dialog)
+    return dialog.result
+
+def show_validation_report(parent, validator, conflicts, blocked):
+    # 顯示匯入檢查結果摘要，有問題時可另存完整報告
+    lines = [f"共檢查 {validator.rows} 筆資料：錯誤 {validator.errors} 個，警告 {validator.warnings} 個"]
+    if conflicts:
+        lines.append(f"與現有資料不同的重複學員：{len(conflicts)} 位")
+    issues = sorted(validator.issues, key=lambda issue: issue[0])
+    for line, name, field, value, level, message in issues[:10]:
+        lines.append(f"第 {line} 列 {name} {field}「{value}」：{level}，{message}")
+    if len(issues) > 10:
+        lines.append(f"……其餘 {len(issues) - 10} 個請見檢查報告")
+    if blocked:
+        lines.append("\n檔案有錯誤，未匯入任何資料，請修正後再匯入。")
+    if not issues:
+        lines.append("檢查通過，可以匯入。")
+        messagebox.showinfo("匯入檢查", "\n".join(lines), parent=parent)
+        return
+
+    lines.append("\n是否儲存完整的檢查報告？")
+    if not messagebox.askyesno("匯入檢查", "\n".join(lines), parent=parent):
+        return
+    file_path = filedialog.asksaveasfilename(parent=parent, defaultextension=".csv", initialfile="匯入檢查報告.csv",
+                                             filetypes=[("CSV檔案", "*.csv")])
+    if file_path:
+        validator.write_report(file_path)
+        messagebox.showinfo("完成", f"檢查報告已儲存至：{file_path}", parent=parent)
+
+class ImportProgressDialog(tk.Toplevel):
+    # 學員匯入在背景執行緒進行，進度經由佇列以 after() 回到主執行緒更新
+    # 不鎖定主視窗，匯入期間仍可掃描簽到
+    # 第一次讀檔同時檢查資料並比對重複學員；dry_run 或檢查有錯誤時只顯示檢查結果，不寫入資料庫
+    POLL_MS = 100
+
+    def __init__(self, parent, title, run, open_rows, on_done, dry_run=False):
+        super().__init__(parent)
+        self.title(title)
+        self.geometry("360x150")
+        self.resizable(False, False)
+        self.transient(parent)
+        self.run = run              # ImportRun：記錄各階段耗時與筆數
+        self.open_rows = open_rows  # 每次呼叫回傳一個新的資料列產生器（比對、匯入各讀一次）
+        self.on_done = on_done      # 結束後於主執行緒呼叫 on_done(結果, 錯誤)；取消時兩者皆為 None
+        self.dry_run = dry_run
+        self.events = queue.Queue()
+        self.decisions = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.read = 0
+        self.total = None
+
+        self.phase_var = tk.StringVar(value="準備匯入...")
+        ttk.Label(self, textvariable=self.phase_var).pack(anchor="w", padx=10, pady=(10, 2))
+        self.progress = ttk.Progressbar(self, mode="indeterminate", length=340)
+        self.progress.pack(padx=10, pady=2)
+        self.progress.start()
+        self.count_var = tk.StringVar()
+        ttk.Label(self, textvariable=self.count_var).pack(anchor="w", padx=10, pady=2)
+        self.cancel_btn = ttk.Button(self, text="取消匯入", command=self.cancel)
+        self.cancel_btn.pack(pady=5)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
+        threading.Thread(target=self._run, daemon=True).start()
+        self.after(self.POLL_MS, self.poll)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.cancel_btn.config(state=tk.DISABLED)
+        self.phase_var.set("正在取消...")
+
+    def _report(self, phase, counts):
+        self.events.put(("progress", (phase, counts)))
+
+    def _run(self):
+        # 背景執行緒：使用本執行緒自己的連線
+        status = "cancelled"
+        counts = {}
+        try:
+            conn = get_conn()
+            validator = ImportValidator(conn)
+            importer = StudentImporter(conn, progress=self._report, cancel_event=self.cancel_event)
+            with self.run.phase("check"):
+                conflicts = importer.find_conflicts(validator.check(self.open_rows()))
+            counts = {"rows": validator.rows, "errors": validator.errors,
+                      "warnings": validator.warnings, "conflicts": len(conflicts)}
+            self.run.log("checked", **counts)
+            self.events.put(("checked", (validator, conflicts)))
+            with self.run.phase("review"):
+                decisions = self.decisions.get()
+            if decisions is None:
+                if self.dry_run:
+                    status = "dry_run"
+                elif validator.errors:
+                    status = "blocked"
+                raise ImportCancelled()
+            with self.run.phase("import"):
+                result = importer.import_rows(validator.normalize(self.open_rows()), decisions)
+            status = "done"
+            counts.update(result)
+            self.events.put(("done", result))
+        except ImportCancelled:
+            self.events.put(("cancelled", None))
+        except Exception as e:
+            status = "error"
+            counts["error"] = str(e)
+            self.events.put(("error", e))
+        finally:
+            self.run.finish(status, **counts)
+            close_conn()
+
+    def poll(self):
+        try:
+            while True:
+                kind, data = self.events.get_nowait()
+                if kind == "progress":
+                    self.show_progress(*data)
+                elif kind == "checked":
+                    validator, conflicts = data
+                    self.total = self.read
+                    if self.cancel_event.is_set():
+                        self.decisions.put(None)
+                    elif self.dry_run or validator.errors:
+                        self.decisions.put(None)
+                        self.destroy()
+                        show_validation_report(self.master, validator, conflicts, blocked=not self.dry_run)
+                        return
+                    else:
+                        self.decisions.put(resolve_duplicates(self, conflicts))
+                else:
+                    self.destroy()
+                    if kind == "done":
+                        self.on_done(data, None)
+                    elif kind == "error":
+                        self.on_done(None, data)
+                    else:
+                        self.on_done(None, None)
+                    return
+        except queue.Empty:
+            pass
+        self.after(self.POLL_MS, self.poll)
+
+    def show_progress(self, phase, counts):
+        self.read = counts["read"]
+        if not self.cancel_event.is_set():
+            self.phase_var.set(IMPORT_PHASES[phase] + "...")
+        if phase == PHASE_CHECK:
+            self.count_var.set(f"已讀取 {counts['read']} 筆")
+            return
+        # 比對時已讀過一次檔案，匯入階段可顯示實際進度
+        if self.total and str(self.progress["mode"]) != "determinate":
+            self.progress.stop()
+            self.progress.config(mode="determinate", maximum=self.total)
+        self.progress["value"] = counts["read"]
+        self.count_var.set(f"已讀取 {counts['read']} 筆　新增 {counts['added']}　更新 {counts['updated']}　跳過 {counts['skipped']}")
+
 class LoginWindow(tk.Toplevel):
     def __init__(self, parent, callback):
         super().__init__(parent)
@@ -343,7 +650,7 @@ class LoginWindow(tk.Toplevel):
         if not username or not password:
             messagebox.showwarning("警告", "請輸入帳號和密碼")
             return
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT id, is_admin FROM users WHERE username=? AND password=?",
                      (username, hashlib.sha256(password.encode()).hexdigest()))
@@ -358,7 +665,7 @@ class LoginWindow(tk.Toplevel):
 class CheckInApp:
     def __init__(self, root):
         self.root = root
-        self._after_ids = []
+        self._after_ids = {}  # 排程名稱 -> after id，同名排程只保留一個
         self.org_info = self.load_org_info()
         self.root.title(f"{self.org_info.get('org_name', '活動(課程)簽到系統')}-活動(課程)簽到系統")
         self.root.geometry("1200x800")
@@ -367,12 +674,17 @@ class CheckInApp:
         self.session_id = None
         self.user_id = None
         self.is_admin = False
+        self.roster_index = None  # 目前課程的 hash -> (student_id, name)，None 表示需重建
+        self.backup_index = None  # 目前課程的備用碼 -> (student_id, name)
+        self.stats = None  # 目前週次的應到/簽到/簽退人數，選擇週次時由資料庫載入
+        self.pending_scans = deque()  # 尚未寫入資料庫的掃描 (student_id, name, session_id, 時間, 收到時刻)
+        self.scan_retry_ms = 0  # 目前的重試間隔，0 表示上次寫入成功
+        self.metrics = ScanMetrics()
 
         self.main_widgets = []  # 新增：記錄所有主介面元件
         self.setup_ui()
         self.load_classes()
-        self.tts_engine = pyttsx3.init()
-        self.tts_engine.setProperty("rate", 160)
+        self.tts = TTSAnnouncer(rate=160, metrics=self.metrics)
 
     def setup_ui(self):
         style = ttk.Style()
@@ -404,6 +716,8 @@ class CheckInApp:
         self.session_combo.bind("<<ComboboxSelected>>", lambda e: self.select_session())
 
         ttk.Button(top_frame, text="匯入名單", command=self.import_attendees).grid(row=1, column=2, padx=5)
+        ttk.Button(top_frame, text="檢查名單", command=lambda: self.import_attendees(dry_run=True)).grid(row=1, column=6, padx=5)
+        ttk.Button(top_frame, text="匯出學期報表", command=self.export_semester_report).grid(row=1, column=7, padx=5)
         ttk.Button(top_frame, text="匯出記錄", command=self.export_records).grid(row=1, column=3, padx=5)
         ttk.Button(top_frame, text="手動簽到/簽退", command=self.open_manual_check_window).grid(row=1, column=4, padx=5)
 
@@ -433,32 +747,54 @@ class CheckInApp:
         self.time_label = ttk.Label(bottom_frame, text="")
         self.time_label.pack(side=tk.LEFT)
 
-        self.stats_label = ttk.Label(bottom_frame, text="", foreground="blue")
+        self.stats_label = ttk.Label(bottom_frame, text="", foreground="blue", cursor="hand2")
         self.stats_label.pack(side=tk.RIGHT)
+        # 點擊統計資訊時重新與資料庫核對
+        self.stats_label.bind("<Button-1>", lambda e: self.reload_stats())
+
+        # 掃描各階段耗時 p50/p95/p99（選擇性顯示）
+        self.metrics_label = ttk.Label(bottom_frame, text="", foreground="gray")
+        self.metrics_label.pack(side=tk.RIGHT, padx=10)
+        self.show_metrics_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bottom_frame, text="顯示掃描耗時", variable=self.show_metrics_var,
+                        command=self.update_metrics_readout).pack(side=tk.RIGHT)
 
         self.update_time()
-        self.update_stats()
+        self.render_stats()
+        self.schedule("metrics_log", METRICS_LOG_INTERVAL_MS, self.write_metrics_summary)
 
         # 登出鈕放在 top_frame 最右側
         self.logout_btn = ttk.Button(top_frame, text="登出", command=self.logout_callback)
         self.logout_btn.grid(row=0, column=99, padx=5, sticky="e")
         self.main_widgets.append(self.logout_btn)
 
-        # 在 update_time, update_stats 等 after 任務都要記錄 after_id
-        self._after_ids.append(self.root.after(1000, self.update_time))
-        self._after_ids.append(self.root.after(1000, self.update_stats))
-
     def set_logout_callback(self, callback):
         self.logout_callback = callback
 
+    def schedule(self, key, delay, callback):
+        # 所有 after 任務都透過此處登記，重複排程時先取消舊的
+        old_id = self._after_ids.pop(key, None)
+        if old_id:
+            self.root.after_cancel(old_id)
+        self._after_ids[key] = self.root.after(delay, callback)
+
+    def cancel_schedule(self, key):
+        after_id = self._after_ids.pop(key, None)
+        if after_id:
+            self.root.after_cancel(after_id)
+
     def destroy(self):
-        # 取消所有 after 任務
-        for after_id in getattr(self, '_after_ids', []):
+        # 先寫入佇列中的掃描，再取消所有 after 任務
+        if getattr(self, 'pending_scans', None):
+            self.flush_all_scans()
+        for after_id in getattr(self, '_after_ids', {}).values():
             try:
                 self.root.after_cancel(after_id)
             except Exception:
                 pass
-        self._after_ids = []
+        self._after_ids = {}
+        if getattr(self, 'tts', None):
+            self.tts.stop()
         # 銷毀 root 下所有 widget（除了 LoginWindow）
         for widget in self.root.winfo_children():
             if not isinstance(widget, LoginWindow):
@@ -513,13 +849,30 @@ class CheckInApp:
     def update_time(self):
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.time_label.config(text=f"目前時間: {now}")
-        self.root.after(1000, self.update_time)
+        self.schedule("time", 1000, self.update_time)
+
+    def update_metrics_readout(self):
+        if not self.show_metrics_var.get():
+            self.cancel_schedule("metrics_readout")
+            self.metrics_label.config(text="")
+            return
+        text = self.metrics.format_readout(METRICS_READOUT_STAGES, METRICS_STAGE_LABELS)
+        self.metrics_label.config(text=text or "尚無掃描資料")
+        self.schedule("metrics_readout", 1000, self.update_metrics_readout)
+
+    def write_metrics_summary(self):
+        try:
+            self.metrics.write_summary()
+        except OSError as e:
+            print(f"寫入掃描耗時記錄失敗：{e}")
+        self.schedule("metrics_log", METRICS_LOG_INTERVAL_MS, self.write_metrics_summary)
 
-    def update_stats(self):
+    def reload_stats(self):
+        # 從資料庫重新計算人數，只在切換週次、名單異動或手動核對時執行
         if not self.class_id or not self.session_id:
-            self.stats_label.config(text="請先選擇活動(課程)及週次")
+            self.stats = None
         else:
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_conn() as conn:
                 c = conn.cursor()
                 c.execute("SELECT COUNT(*) FROM students s INNER JOIN class_students cs ON cs.student_id = s.id WHERE cs.class_id=?", (self.class_id,))
                 total = c.fetchone()[0]
@@ -527,20 +880,38 @@ class CheckInApp:
                 c.execute("SELECT COUNT(DISTINCT student_id) FROM checkins WHERE session_id=? AND check_in_time IS NOT NULL", (self.session_id,))
                 checked_in = c.fetchone()[0]
 
-                unchecked_in = total - checked_in
-
                 c.execute("SELECT COUNT(DISTINCT student_id) FROM checkins WHERE session_id=? AND check_out_time IS NOT NULL", (self.session_id,))
                 checked_out = c.fetchone()[0]
 
-                unchecked_out = checked_in - checked_out
+            self.stats = {"total": total, "checked_in": checked_in, "checked_out": checked_out}
+        self.render_stats()
 
-                stats_text = (f"應到: {total}  |  簽到: {checked_in}  |  未簽到: {unchecked_in}  |  "
-                              f"簽退: {checked_out}  |  未簽退: {unchecked_out}")
-                self.stats_label.config(text=stats_text)
-        self.root.after(1000, self.update_stats)
+    def count_transition(self, check_in_time=None, check_out_time=None):
+        # 簽到/簽退寫入後直接累加計數，不必再查詢資料庫
+        if self.stats is None:
+            self.reload_stats()
+            return
+        if check_in_time:
+            self.stats["checked_in"] += 1
+        if check_out_time:
+            self.stats["checked_out"] += 1
+        self.render_stats()
+
+    def render_stats(self):
+        if self.stats is None:
+            self.stats_label.config(text="請先選擇活動(課程)及週次")
+            return
+        total = self.stats["total"]
+        checked_in = self.stats["checked_in"]
+        checked_out = self.stats["checked_out"]
+        unchecked_in = total - checked_in
+        unchecked_out = checked_in - checked_out
+        stats_text = (f"應到: {total}  |  簽到: {checked_in}  |  未簽到: {unchecked_in}  |  "
+                      f"簽退: {checked_out}  |  未簽退: {unchecked_out}")
+        self.stats_label.config(text=stats_text)
 
     def load_classes(self):
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT id, name, type FROM classes")
             data = c.fetchall()
@@ -560,10 +931,19 @@ class CheckInApp:
     def select_class(self):
         selected = self.class_combo.get()
         if selected in self.class_map:
+            # 排隊中的掃描屬於目前的課程，全部寫入後才切換；寫入失敗時維持原本的選擇
+            if not self.flush_all_scans():
+                self.restore_selection(self.class_combo, self.class_map, self.class_id)
+                return
             self.class_id = self.class_map[selected]
+            self.build_roster_index()
             self.load_sessions()
             self.load_attendees()
-            self.update_stats()
+            self.reload_stats()
+
+    def restore_selection(self, combo, mapping, current_id):
+        # 取消切換時，下拉選單改回目前的課程/週次
+        combo.set(next((label for label, value in mapping.items() if value == current_id), ""))
 
     def add_class(self):
         # 建立課程類型選擇視窗
@@ -591,7 +971,7 @@ class CheckInApp:
             type_dialog.destroy()
             name = simpledialog.askstring("新增活動(課程)", "輸入活動(課程)名稱")
             if name:
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     c.execute("INSERT INTO classes (name, type) VALUES (?, ?)", (name, selected_type.get()))
                     conn.commit()
@@ -600,14 +980,53 @@ class CheckInApp:
                 # 如果是單次類型，自動開啟新增堂次視窗
                 if selected_type.get() in ["single_event", "single_meeting", "single_class"]:
                     self.class_id = c.lastrowid
+                    self.invalidate_roster_index()
                     self.add_session()
         
         ttk.Button(type_dialog, text="確定", command=on_type_selected).pack(pady=10)
 
+    def build_roster_index(self):
+        # 建立目前課程的學員索引，掃描時直接查表不必再連資料庫
+        self.roster_index = {}
+        self.backup_index = {}
+        if not self.class_id:
+            return
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT s.hash, s.id, s.name
+                FROM students s
+                INNER JOIN class_students cs ON cs.student_id = s.id
+                WHERE cs.class_id = ?
+            """, (self.class_id,))
+            for h, sid, name in c.fetchall():
+                if h:
+                    self.roster_index[h] = (sid, name)
+                    self.backup_index[backup_code(h)] = (sid, name)
+
+    def invalidate_roster_index(self):
+        # 課程名單或學員資料異動後呼叫，下次掃描時重建索引
+        self.roster_index = None
+        self.backup_index = None
+
+    def lookup_roster(self, code):
+        if self.roster_index is None:
+            self.build_roster_index()
+        return self.roster_index.get(code)
+
+    def lookup_backup_code(self, code):
+        if self.backup_index is None:
+            self.build_roster_index()
+        return self.backup_index.get(code)
+
+    def on_roster_changed(self):
+        self.invalidate_roster_index()
+        self.reload_stats()
+
     def load_sessions(self):
         if not self.class_id:
             return
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT id, week, date, start_time, end_time FROM sessions WHERE class_id=? ORDER BY week", (self.class_id,))
             data = c.fetchall()
@@ -618,9 +1037,12 @@ class CheckInApp:
     def select_session(self):
         selected = self.session_combo.get()
         if selected in self.session_map:
+            if not self.flush_all_scans():
+                self.restore_selection(self.session_combo, self.session_map, self.session_id)
+                return
             self.session_id = self.session_map[selected]
             self.load_attendees()
-            self.update_stats()
+            self.reload_stats()
 
     def add_session(self):
         if not self.class_id:
@@ -628,7 +1050,7 @@ class CheckInApp:
             return
 
         # 檢查課程類型
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT type FROM classes WHERE id=?", (self.class_id,))
             class_type = c.fetchone()[0]
@@ -674,7 +1096,7 @@ class CheckInApp:
                     messagebox.showwarning("警告", "請輸入開始與結束時間")
                     return
 
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     c.execute(
                         "INSERT INTO sessions (class_id, week, date, start_time, end_time) VALUES (?, ?, ?, ?, ?)",
@@ -696,7 +1118,7 @@ class CheckInApp:
             self.tree.delete(row)
         if not self.class_id or not self.session_id:
             return
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("""
             SELECT s.id, s.name, s.department,
@@ -715,6 +1137,17 @@ class CheckInApp:
                     cout if cout else ""
                 ))
 
+    def update_attendee_row(self, sid, check_in_time=None, check_out_time=None):
+        # 掃描後只更新該學員那一列（iid 即學員 id），不重建整份名單
+        iid = str(sid)
+        if not self.tree.exists(iid):
+            self.load_attendees()
+            return
+        if check_in_time:
+            self.tree.set(iid, "簽到時間", check_in_time)
+        if check_out_time:
+            self.tree.set(iid, "簽退時間", check_out_time)
+
     def open_manual_check_window(self):
         if not self.session_id:
             self.show_timed_popup("請先選擇週次", popup_type="warning", duration=4)
@@ -736,51 +1169,31 @@ class CheckInApp:
             if not code:
                 return
 
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                # 先檢查學員是否存在
-                c.execute("SELECT id, name FROM students WHERE substr(hash, 1, 10) = ?", (code,))
-                student = c.fetchone()
-                
-                if not student:
-                    self.show_timed_popup("查無此學員或備用碼錯誤", popup_type="error", duration=5)
-                    return
-                
-                sid, name = student
-                
-                # 檢查學員是否已加入課程
-                c.execute("SELECT 1 FROM class_students WHERE class_id = ? AND student_id = ?", 
-                         (self.class_id, sid))
-                if not c.fetchone():
-                    self.show_timed_popup(f"{name} 尚未加入此課程，請先加入課程", popup_type="warning", duration=5)
-                    return
-
-                now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                c.execute("SELECT check_in_time, check_out_time FROM checkins WHERE session_id=? AND student_id=?",
-                          (self.session_id, sid))
-                row = c.fetchone()
-
-                if not row:
-                    c.execute("INSERT INTO checkins (session_id, student_id, check_in_time) VALUES (?, ?, ?)",
-                              (self.session_id, sid, now_str))
-                    self.show_timed_popup(f"{name} 簽到成功", popup_type="success", duration=5)
+            started = time.perf_counter()
+            # 先從本課程名單索引查詢備用碼
+            with self.metrics.measure("manual_lookup"):
+                student = self.lookup_backup_code(code)
+            if not student:
+                # 不在名單內時才查資料庫（走備用碼索引），用來區分錯誤訊息
+                with get_conn() as conn:
+                    c = conn.cursor()
+                    c.execute("SELECT name FROM students WHERE substr(hash, 1, 10) = ?", (code,))
+                    row = c.fetchone()
+                if row:
+                    self.show_timed_popup(f"{row[0]} 尚未加入此課程，請先加入課程", popup_type="warning", duration=5)
                 else:
-                    cin, cout = row
-                    if cin and not cout:
-                        c.execute("UPDATE checkins SET check_out_time=? WHERE session_id=? AND student_id=?",
-                                  (now_str, self.session_id, sid))
-                        self.show_timed_popup(f"{name} 簽退成功", popup_type="success", duration=5)
-                    elif cin and cout:
-                        self.show_timed_popup(f"{name} 已簽退，無法重複簽到", popup_type="info", duration=5)
-                    else:
-                        c.execute("UPDATE checkins SET check_in_time=? WHERE session_id=? AND student_id=?",
-                                  (now_str, self.session_id, sid))
-                        self.show_timed_popup(f"{name} 簽到成功", popup_type="success", duration=5)
-
-                conn.commit()
+                    self.show_timed_popup("查無此學員或備用碼錯誤", popup_type="error", duration=5)
+                return
 
-            self.load_attendees()
-            self.update_stats()
+            sid, name = student
+            if not self.flush_scans():  # 先寫入排隊中的掃描，維持先後順序
+                return
+            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with self.metrics.measure("manual_write"):
+                with get_conn() as conn:
+                    result = toggle_checkin(conn, self.session_id, sid, now_str)
+            self.apply_transition(sid, name, *result)
+            self.metrics.record("manual_total", (time.perf_counter() - started) * 1000)
             win.destroy()
             self.scan_entry.focus_set()  # ✅ 執行完自動回到掃描框
 
@@ -797,49 +1210,81 @@ class CheckInApp:
         if not code:
             return
 
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT s.id, s.name 
-                FROM students s
-                INNER JOIN class_students cs ON cs.student_id = s.id
-                WHERE cs.class_id = ? AND s.hash = ?
-            """, (self.class_id, code))
-            student = c.fetchone()
-
-            if not student:
-                self.show_timed_popup("查無此學員或QR碼錯誤", popup_type="error", duration=5)
-                return
-
-            sid, name = student
-            c.execute("SELECT check_in_time, check_out_time FROM checkins WHERE session_id=? AND student_id=?",
-                      (self.session_id, sid))
-            row = c.fetchone()
-            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            if not row:
-                c.execute("INSERT INTO checkins (session_id, student_id, check_in_time) VALUES (?, ?, ?)",
-                          (self.session_id, sid, now_str))
-                self.show_timed_popup(f"{name} 簽到成功", popup_type="success", duration=5)
-            else:
-                cin, cout = row
-                if cin and not cout:
-                    c.execute("UPDATE checkins SET check_out_time=? WHERE session_id=? AND student_id=?",
-                              (now_str, self.session_id, sid))
-                    self.show_timed_popup(f"{name} 簽退成功", popup_type="success", duration=5)
-                elif cin and cout:
-                    self.show_timed_popup(f"{name} 已簽退，無法重複簽到", popup_type="info", duration=5)
-                else:
-                    c.execute("UPDATE checkins SET check_in_time=? WHERE session_id=? AND student_id=?",
-                              (now_str, self.session_id, sid))
-                    self.show_timed_popup(f"{name} 簽到成功", popup_type="success", duration=5)
-
-            conn.commit()
+        started = time.perf_counter()
+        with self.metrics.measure("lookup"):
+            student = self.lookup_roster(code)
+        if not student:
+            self.show_timed_popup("查無此學員或QR碼錯誤", popup_type="error", duration=5)
+            return
 
-        self.load_attendees()
-        self.update_stats()
+        # 掃描先排入佇列並立即返回，讓掃描槍的下一筆輸入不被資料庫寫入卡住
+        sid, name = student
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.pending_scans.append((sid, name, self.session_id, now_str, started))
+        if len(self.pending_scans) >= SCAN_BATCH_SIZE and not self.scan_retry_ms:
+            self.flush_scans()
+        elif "scan_flush" not in self._after_ids:
+            self.schedule("scan_flush", SCAN_FLUSH_MS, self.flush_scans)
+
+    def flush_scans(self):
+        # 將佇列中的掃描在同一個交易內寫入，再逐筆更新畫面；寫入失敗時回傳 False
+        self.cancel_schedule("scan_flush")
+        if not self.pending_scans:
+            return True
+        batch = [self.pending_scans.popleft() for _ in range(min(len(self.pending_scans), SCAN_BATCH_SIZE))]
+        results = []
+        try:
+            with self.metrics.measure("write"):
+                with get_conn() as conn:
+                    for sid, name, session_id, now_str, _ in batch:
+                        results.append((sid, name) + toggle_checkin(conn, session_id, sid, now_str))
+        except sqlite3.OperationalError as e:
+            # 交易已整批還原：依原順序放回佇列前端，稍後重試
+            self.pending_scans.extendleft(reversed(batch))
+            if not self.scan_retry_ms:
+                self.show_timed_popup(f"簽到寫入失敗，將自動重試：{e}", popup_type="error", duration=5)
+            self.scan_retry_ms = min(max(self.scan_retry_ms * 2, SCAN_FLUSH_MS * 10), SCAN_RETRY_MAX_MS)
+            self.schedule("scan_flush", self.scan_retry_ms, self.flush_scans)
+            return False
+        self.scan_retry_ms = 0
+        for result, queued in zip(results, batch):
+            self.apply_transition(*result, session_id=queued[2])
+            self.metrics.record("scan_total", (time.perf_counter() - queued[-1]) * 1000)
+        if self.pending_scans:
+            self.schedule("scan_flush", SCAN_FLUSH_MS, self.flush_scans)
+        return True
+
+    def flush_all_scans(self):
+        # 登出或關閉前寫入所有排隊中的掃描，仍無法寫入時告知未寫入的筆數
+        while self.pending_scans:
+            if not self.flush_scans():
+                messagebox.showerror("錯誤", f"資料庫忙碌中，尚有 {len(self.pending_scans)} 筆掃描尚未寫入，請稍後再試")
+                return False
+        return True
+
+    def apply_transition(self, sid, name, status, check_in_time, check_out_time, session_id=None):
+        # 依 toggle_checkin 的結果更新畫面，不需再查詢資料庫
+        # 掃描屬於其他週次時（例如切換前排隊的掃描）只顯示訊息，不更新目前週次的名單與計數
+        current = session_id is None or session_id == self.session_id
+        if status == CHECKED_IN:
+            if current:
+                with self.metrics.measure("row"):
+                    self.update_attendee_row(sid, check_in_time=check_in_time)
+                with self.metrics.measure("stats"):
+                    self.count_transition(check_in_time=check_in_time)
+            self.show_timed_popup(f"{name} 簽到成功", popup_type="success", duration=5)
+        elif status == CHECKED_OUT:
+            if current:
+                with self.metrics.measure("row"):
+                    self.update_attendee_row(sid, check_out_time=check_out_time)
+                with self.metrics.measure("stats"):
+                    self.count_transition(check_out_time=check_out_time)
+            self.show_timed_popup(f"{name} 簽退成功", popup_type="success", duration=5)
+        else:
+            self.show_timed_popup(f"{name} 已簽退，無法重複簽到", popup_type="info", duration=5)
 
     def show_timed_popup(self, message, popup_type="info", duration=5):
+        started = time.perf_counter()
         popup = tk.Toplevel(self.root)
         popup.withdraw()
         popup.title({
@@ -884,25 +1329,12 @@ class CheckInApp:
             else:
                 popup.destroy()
                 self.scan_entry.focus_set()
-        try:
-            self.tts_engine.say(message)
-            self.tts_engine.runAndWait()
-        except Exception as e:
-            print(f"TTS 撥放失敗：{e}")
+        self.tts.say(message)
         update_countdown(duration)
+        self.metrics.record("popup", (time.perf_counter() - started) * 1000)
 
-    def import_attendees(self):
-        # 設定日誌檔案
-        log_file = "import_log.txt"
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write("開始匯入程序...\n")
-        
-        def log_message(msg):
-            print(msg)
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(f"{msg}\n")
-        
-        if not self.class_id:
+    def import_attendees(self, dry_run=False):
+        if not dry_run and not self.class_id:
             messagebox.showwarning("警告", "請先選擇活動(課程)")
             return
             
@@ -910,181 +1342,38 @@ class CheckInApp:
         if not file_path:
             return
             
-        log_message(f"選擇的檔案：{file_path}")
-        
+        run = ImportRun("attendees", file_path)
         try:
-            with open(file_path, newline='', encoding="utf-8") as csvfile:
-                reader = csv.reader(csvfile)
-                headers = next(reader)
-                log_message(f"CSV 標題列: {headers}")
-                rows = list(reader)
-                log_message(f"讀取到 {len(rows)} 筆資料")
-        except UnicodeDecodeError:
-            with open(file_path, newline='', encoding="cp950") as csvfile:
-                reader = csv.reader(csvfile)
-                headers = next(reader)
-                log_message(f"CSV 標題列 (cp950): {headers}")
-                rows = list(reader)
-                log_message(f"讀取到 {len(rows)} 筆資料 (cp950)")
-        
-        added = 0
-        skipped = 0
-        updated = 0
-        duplicate_action = None  # None=詢問, "skip"=跳過, "update"=更新, "skip_all"=跳過全部, "update_all"=強制更新全部
-        
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            for row in rows:
-                name = row.get("姓名", "").strip()
-                dept = row.get("部門", "").strip()
-                if not name:
-                    continue
-                
-                # 檢查學員是否已存在
-                c.execute("SELECT id FROM students WHERE name=?", (name,))
-                student = c.fetchone()
-                
-                if student:
-                    student_id = student[0]
-                    
-                    if duplicate_action is None:
-                        # 取得現有資料
-                        c.execute("""
-                            SELECT s.department, s.gender, s.phone, s.dietary,
-                                   f.field_name, scv.field_value
-                            FROM students s
-                            LEFT JOIN student_custom_values scv ON scv.student_id = s.id
-                            LEFT JOIN custom_fields f ON f.id = scv.field_id
-                            WHERE s.id = ?
-                            ORDER BY f.display_order
-                        """, (student_id,))
-                        existing_data = c.fetchall()
-                        
-                        existing_dept = existing_data[0][0] if existing_data else ""
-                        existing_gender = existing_data[0][1] if existing_data else ""
-                        existing_phone = existing_data[0][2] if existing_data else ""
-                        existing_dietary = existing_data[0][3] if existing_data else ""
-                        
-                        existing_custom = "\n".join([f"{row[4]}：{row[5]}" for row in existing_data if row[4] and row[5]])
-                        
-                        new_data = f"部門：{row.get('部門', '')}\n"
-                        new_data += f"性別：{row.get('性別', '')}\n"
-                        new_data += f"連絡電話：{row.get('連絡電話', '')}\n"
-                        new_data += f"餐飲葷素：{row.get('餐飲葷素', '')}\n"
-                        for field_id, field_name, _ in custom_fields:
-                            if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                                value = row.get(field_name, "")
-                                if value:
-                                    new_data += f"{field_name}：{value}\n"
-                        
-                        response = messagebox.askyesnocancel(
-                            "發現重複學員",
-                            f"發現重複學員：{name}\n\n"
-                            f"現有資料：\n"
-                            f"部門：{existing_dept}\n"
-                            f"性別：{existing_gender}\n"
-                            f"連絡電話：{existing_phone}\n"
-                            f"餐飲葷素：{existing_dietary}\n"
-                            f"{existing_custom}\n\n"
-                            f"新資料：\n{new_data}\n"
-                            "是否要覆蓋現有資料？\n"
-                            "是 = 覆蓋\n"
-                            "否 = 跳過\n"
-                            "取消 = 顯示更多選項"
-                        )
-                        
-                        if response is None:  # 取消，顯示更多選項
-                            response = messagebox.askyesnocancel(
-                                "更多選項",
-                                "選擇處理方式：\n"
-                                "是 = 跳過所有重複\n"
-                                "否 = 強制更新所有重複\n"
-                                "取消 = 返回上一層"
-                            )
-                            if response is None:  # 返回上一層
-                                continue
-                            elif response:  # 跳過所有重複
-                                duplicate_action = "skip_all"
-                                skipped += 1
-                                continue
-                            else:  # 強制更新所有重複
-                                duplicate_action = "update_all"
-                        elif response:  # 覆蓋
-                            duplicate_action = "update"
-                        else:  # 跳過
-                            duplicate_action = "skip"
-                            skipped += 1
-                            continue
-                    
-                    if duplicate_action == "skip_all":
-                        skipped += 1
-                        continue
-                    elif duplicate_action == "update_all":
-                        # 強制更新所有重複
-                        pass
-                    elif duplicate_action == "skip":
-                        skipped += 1
-                        continue
-                    elif duplicate_action == "update":
-                        # 更新基本資料
-                        c.execute("""
-                            UPDATE students 
-                            SET department=?, gender=?, phone=?, dietary=?
-                            WHERE id=?
-                        """, (dept, row.get("性別", ""), row.get("連絡電話", ""), 
-                              row.get("餐飲葷素", ""), student_id))
-                        
-                        # 更新自定義欄位值
-                        c.execute("DELETE FROM student_custom_values WHERE student_id=?", (student_id,))
-                        for field_id, field_name, _ in custom_fields:
-                            if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                                value = row.get(field_name, "").strip()
-                                if value:
-                                    c.execute("""
-                                        INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                        VALUES (?, ?, ?)
-                                    """, (student_id, field_id, value))
-                        updated += 1
-                        continue
-                
-                try:
-                    h = hash_name(name)
-                    # 插入基本資料
-                    c.execute("""
-                        INSERT INTO students (name, department, hash, gender, phone, dietary) 
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (name, dept, h,
-                          row.get("性別", ""),
-                          row.get("連絡電話", ""),
-                          row.get("餐飲葷素", "")))
-                    
-                    student_id = c.lastrowid
-                    
-                    # 插入其他自定義欄位值
-                    for field_id, field_name, _ in custom_fields:
-                        if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                            value = row.get(field_name, "").strip()
-                            if value:
-                                c.execute("""
-                                    INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                    VALUES (?, ?, ?)
-                                """, (student_id, field_id, value))
-                    
-                    added += 1
-                except sqlite3.IntegrityError:
-                    continue
-            conn.commit()
-        
-        result_message = f"匯入完成：\n"
-        if added > 0:
-            result_message += f"新增：{added} 位\n"
-        if updated > 0:
-            result_message += f"更新：{updated} 位\n"
-        if skipped > 0:
-            result_message += f"跳過：{skipped} 位"
-        
-        messagebox.showinfo("匯入完成", result_message)
-        self.load_students()
+            encoding = detect_encoding(file_path)
+        except Exception as e:
+            run.finish("error", error=str(e))
+            messagebox.showerror("錯誤", f"讀取CSV檔案失敗：{str(e)}")
+            return
+        run.log("encoding", encoding=encoding)
+
+        def on_done(result, error):
+            if error is not None:
+                messagebox.showerror("錯誤", f"匯入CSV檔案失敗：{str(error)}")
+                return
+            if result is None:
+                messagebox.showinfo("匯入取消", "已取消匯入，資料未變更")
+                return
+            added, updated, skipped = result["added"], result["updated"], result["skipped"]
+
+            result_message = f"匯入完成：\n"
+            if added > 0:
+                result_message += f"新增：{added} 位\n"
+            if updated > 0:
+                result_message += f"更新：{updated} 位\n"
+            if skipped > 0:
+                result_message += f"跳過：{skipped} 位"
+
+            messagebox.showinfo("匯入完成", result_message)
+            self.load_attendees()
+
+        # 逐列串流讀取，比對與匯入各讀一次
+        ImportProgressDialog(self.root, "檢查名單" if dry_run else "匯入學員", run,
+                             lambda: iter_csv_rows(file_path, encoding), on_done, dry_run=dry_run)
 
     def export_records(self):
         if not self.class_id or not self.session_id:
@@ -1096,112 +1385,40 @@ class CheckInApp:
         if not file_path:
             return
 
-        # 註冊微軟正黑體（Windows 系統）
-        if platform.system() == "Windows":
-            font_path = os.path.join(os.environ['WINDIR'], 'Fonts', 'msjh.ttc')
-            if not os.path.exists(font_path):
-                messagebox.showerror("錯誤", "找不到微軟正黑體字型（msjh.ttc）")
-                return
-            pdfmetrics.registerFont(TTFont('MicrosoftJhengHei', font_path))
-            font_name = 'MicrosoftJhengHei'
-        else:
-            messagebox.showerror("錯誤", "目前僅支援 Windows 系統的中文字型顯示")
-            return
-
         # 從資料庫讀取資料與課程/堂次資訊
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
+        with get_conn() as conn:
+            class_name, session_info, records = load_session_attendance(conn, self.class_id, self.session_id)
 
-            # 活動(課程)名稱
-            c.execute("SELECT name FROM classes WHERE id=?", (self.class_id,))
-            row = c.fetchone()
-            class_name = row[0] if row else "(未知活動(課程))"
+        try:
+            export_attendance_pdf(file_path, self.org_info, class_name, session_info, records)
+            messagebox.showinfo("匯出完成", "PDF 匯出成功")
+        except Exception as e:
+            messagebox.showerror("錯誤", f"匯出 PDF 失敗：{e}")
 
-            # 堂次資訊
-            c.execute("SELECT week, date, start_time, end_time FROM sessions WHERE id=?", (self.session_id,))
-            session_data = c.fetchone()
-            if session_data:
-                week, date, start, end = session_data
-                session_info = f"第{week}週  {date}  {start}~{end}"
-            else:
-                session_info = "(未知堂次)"
+    def export_semester_report(self):
+        # 整個活動(課程)所有週次的 學員 × 週次 出席矩陣，依副檔名輸出 Excel 或 PDF
+        if not self.class_id:
+            messagebox.showwarning("警告", "請先選擇活動(課程)")
+            return
 
-            # 出席記錄
-            c.execute("""
-                SELECT a.name, a.department, ci.check_in_time, ci.check_out_time
-                FROM students a
-                INNER JOIN class_students cs ON cs.student_id = a.id
-                LEFT JOIN checkins ci ON ci.student_id = a.id AND ci.session_id = ?
-                WHERE cs.class_id = ?
-                ORDER BY a.name
-            """, (self.session_id, self.class_id))
-            records = c.fetchall()
+        file_path = filedialog.asksaveasfilename(defaultextension=".xlsx",
+                                                 filetypes=[("Excel檔案", "*.xlsx"), ("PDF檔案", "*.pdf")])
+        if not file_path:
+            return
 
-            # 統計資訊
-            total = len(records)
-            checked_in = sum(1 for r in records if r[2])
-            checked_out = sum(1 for r in records if r[3])
-            unchecked_in = total - checked_in
-            unchecked_out = checked_in - checked_out
-            stats_text = (f"應到: {total}  |  簽到: {checked_in}  |  未簽到: {unchecked_in}  |  "
-                          f"簽退: {checked_out}  |  未簽退: {unchecked_out}")
+        with get_conn() as conn:
+            row = conn.execute("SELECT name FROM classes WHERE id=?", (self.class_id,)).fetchone()
+            class_name = row[0] if row else "(未知活動(課程))"
+            matrix = load_attendance_matrix(conn, self.class_id)
 
         try:
-            pdf = Canvas(file_path, pagesize=A4)
-            width, height = A4
-
-            # 畫列印時間
-            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            pdf.setFont(font_name, 10)
-            pdf.drawRightString(width - 50, height - 30, f"列印日期：{now_str}")
-
-            # 標題與課程資訊
-            y = height - 60
-            pdf.setFont(font_name, 14)
-            pdf.drawString(50, y, "簽到記錄報表")
-            y -= 20
-            pdf.setFont(font_name, 12)
-            # 單位資訊
-            y -= 20
-            pdf.setFont(font_name, 12)
-            pdf.drawString(50, y, f"單位名稱：{self.org_info.get('org_name', '')}")
-            y -= 20
-            pdf.drawString(50, y, f"管理人員：{self.org_info.get('manager', '')}")
-            y -= 20
-            pdf.drawString(50, y, f"聯絡方式：{self.org_info.get('contact', '')}")
-            y -= 20
-            pdf.drawString(50, y, f"課程名稱：{class_name}")
-            y -= 20
-            pdf.drawString(50, y, f"堂次資訊：{session_info}")
-
-            y -= 20
-            pdf.setFont(font_name, 11)
-            pdf.drawString(50, y, f"統計資訊：{stats_text}")
-
-            # 建立表格資料
-            table_data = [["姓名", "部門", "簽到時間", "簽退時間"]]
-            table_data += records
-
-            # 建立表格
-            table = Table(table_data, colWidths=[100, 100, 150, 150])
-            table.setStyle(TableStyle([
-                ('FONTNAME', (0, 0), (-1, -1), font_name),
-                ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTSIZE', (0, 0), (-1, -1), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ]))
-
-            # 繪製表格
-            table_width, table_height = table.wrap(0, 0)
-            table.drawOn(pdf, 50, y - 40 - table_height)
-
-            pdf.save()
-            messagebox.showinfo("匯出完成", "PDF 匯出成功")
+            if file_path.lower().endswith(".pdf"):
+                export_matrix_pdf(file_path, self.org_info, class_name, matrix)
+            else:
+                export_matrix_xlsx(file_path, class_name, matrix)
+            messagebox.showinfo("匯出完成", "學期報表匯出成功")
         except Exception as e:
-            messagebox.showerror("錯誤", f"匯出 PDF 失敗：{e}")
+            messagebox.showerror("錯誤", f"匯出學期報表失敗：{e}")
 
     def generate_qrcodes(self):
         if not self.class_id:
@@ -1212,52 +1429,11 @@ class CheckInApp:
         if not folder_path:
             return
 
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT s.name, s.hash
-                FROM students s
-                INNER JOIN class_students cs ON cs.student_id = s.id
-                WHERE cs.class_id = ?
-            """, (self.class_id,))
-            students = c.fetchall()
-            
-            if not students:
-                messagebox.showwarning("警告", "此課堂尚無學員")
-                return
-
-            for name, h in students:
-                backup_code = h[:10]
-
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_H,
-                    box_size=10,
-                    border=4,
-                )
-                qr.add_data(h)
-                qr.make(fit=True)
-                qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-
-                from PIL import ImageDraw, ImageFont
-                width, height = qr_img.size
-                new_height = height + 80
-                final_img = Image.new("RGB", (width, new_height), "white")
-                final_img.paste(qr_img, (0, 0))
-
-                draw = ImageDraw.Draw(final_img)
-                try:
-                    font = ImageFont.truetype("msjh.ttf", 20)
-                except:
-                    font = ImageFont.load_default()
-                text = f"{name}｜備用碼：{backup_code}"
-
-                bbox = draw.textbbox((0, 0), text, font=font)
-                text_width = bbox[2] - bbox[0]
-                text_height = bbox[3] - bbox[1]
-
-                draw.text(((width - text_width) / 2, height + 10), text, fill="black", font=font)
-                final_img.save(os.path.join(folder_path, f"{name}.png"))
+        with get_conn() as conn:
+            count = export_class_qrcodes(conn, self.class_id, folder_path)
+        if not count:
+            messagebox.showwarning("警告", "此課堂尚無學員")
+            return
 
         messagebox.showinfo("完成", f"QR Code（含備用碼）已儲存至 {folder_path}")
 
@@ -1269,19 +1445,20 @@ class CheckInApp:
         confirm = messagebox.askyesno("確認刪除", f"確定刪除選取的 {len(selected)} 位學員嗎？")
         if not confirm:
             return
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             for sid in selected:
                 c.execute("DELETE FROM class_students WHERE class_id=? AND student_id=?", (self.class_id, sid))
             conn.commit()
-        self.load_attendees()
-        self.update_stats()
+        self.invalidate_roster_index()
+        self.tree.delete(*selected)
+        self.reload_stats()
 
     def open_manage_dialog(self):
         if not self.class_id:
             messagebox.showwarning("警告", "請先選擇活動(課程)")
             return
-        ManageAttendeesDialog(self.root, self.class_id, self.update_stats)
+        ManageAttendeesDialog(self.root, self.class_id, self.on_roster_changed)
 
     def open_user_management(self):
         if not self.is_admin:
@@ -1302,7 +1479,7 @@ class CheckInApp:
         def load_users():
             for item in tree.get_children():
                 tree.delete(item)
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_conn() as conn:
                 c = conn.cursor()
                 c.execute("SELECT id, username, is_admin FROM users")
                 for uid, username, is_admin in c.fetchall():
@@ -1332,7 +1509,7 @@ class CheckInApp:
                     messagebox.showwarning("警告", "請輸入帳號和密碼")
                     return
                 try:
-                    with sqlite3.connect(DB_FILE) as conn:
+                    with get_conn() as conn:
                         c = conn.cursor()
                         c.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)",
                                 (username, hashlib.sha256(password.encode()).hexdigest(), int(is_admin_var.get())))
@@ -1350,7 +1527,7 @@ class CheckInApp:
                 messagebox.showwarning("警告", "請選擇要刪除的使用者")
                 return
             if messagebox.askyesno("確認", "確定要刪除選取的使用者嗎？"):
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     for uid in selected:
                         c.execute("DELETE FROM users WHERE id=?", (uid,))
@@ -1368,7 +1545,7 @@ class CheckInApp:
                 
             new_password = simpledialog.askstring("重設密碼", "請輸入新密碼：", show="*")
             if new_password:
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     c.execute("UPDATE users SET password=? WHERE id=?",
                             (hashlib.sha256(new_password.encode()).hexdigest(), selected[0]))
@@ -1386,15 +1563,18 @@ class CheckInApp:
         load_users()
 
     def open_student_management(self):
-        StudentManagementDialog(self.root)
+        StudentManagementDialog(self.root, self.on_roster_changed)
 
     def logout_callback(self):
+        self.flush_all_scans()
+        close_conn()
         python = sys.executable
         os.execl(python, python, *sys.argv)
 
 class StudentManagementDialog(tk.Toplevel):
-    def __init__(self, parent):
+    def __init__(self, parent, on_change=None):
         super().__init__(parent)
+        self.on_change = on_change  # 學員姓名/hash 異動時通知主畫面
         self.title("學員管理")
         self.geometry("800x600")
         self.resizable(False, False)
@@ -1430,6 +1610,7 @@ class StudentManagementDialog(tk.Toplevel):
         ttk.Button(btn_frame, text="編輯學員", command=self.edit_student).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="刪除學員", command=self.delete_student).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="匯入學員", command=self.import_students).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="檢查匯入檔", command=lambda: self.import_students(dry_run=True)).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="匯出學員", command=self.export_students).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="管理欄位", command=self.manage_fields).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="關閉", command=self.destroy).pack(side=tk.RIGHT, padx=5)
@@ -1439,15 +1620,18 @@ class StudentManagementDialog(tk.Toplevel):
     def load_students(self):
         for row in self.tree.get_children():
             self.tree.delete(row)
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT id, name, department, gender, phone, dietary 
-                FROM students 
-                ORDER BY name
-            """)
-            for sid, name, dept, gender, phone, dietary in c.fetchall():
-                self.tree.insert("", tk.END, iid=sid, values=(name, dept, gender, phone, dietary))
+        with get_conn() as conn:
+            fields = student_custom_fields(conn)
+            # 自定義欄位依欄位設定接在基本資料之後，可橫向捲動
+            columns = ["name", "dept", "gender", "phone", "dietary"] + [f"field_{i}" for i in range(len(fields))]
+            labels = [label for label, _ in STUDENT_COLUMNS] + [field_name for field_name, _ in fields]
+            self.tree["columns"] = columns
+            for col, label in zip(columns, labels):
+                self.tree.heading(col, text=label)
+            for col in columns[len(STUDENT_COLUMNS):]:
+                self.tree.column(col, width=100, stretch=False)
+            for sid, *values in iter_student_wide_rows(conn, fields):
+                self.tree.insert("", tk.END, iid=sid, values=[value if value is not None else "" for value in values])
 
     def filter_students(self, *args):
         search_text = self.search_var.get().lower()
@@ -1459,6 +1643,10 @@ class StudentManagementDialog(tk.Toplevel):
                 self.tree.item(item, tags=('hidden',))
         self.tree.tag_configure('hidden', foreground='gray')
 
+    def notify_change(self):
+        if self.on_change:
+            self.on_change()
+
     def add_student(self):
         dialog = tk.Toplevel(self)
         dialog.title("新增學員")
@@ -1482,7 +1670,7 @@ class StudentManagementDialog(tk.Toplevel):
         row += 1
         # 性別
         gender_var = tk.StringVar()
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT option_value FROM field_options WHERE field_id=1 ORDER BY display_order")
             gender_options = [row_[0] for row_ in c.fetchall()]
@@ -1496,7 +1684,7 @@ class StudentManagementDialog(tk.Toplevel):
         row += 1
         # 餐飲葷素
         dietary_var = tk.StringVar()
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT option_value FROM field_options WHERE field_id=5 ORDER BY display_order")
             dietary_options = [row_[0] for row_ in c.fetchall()]
@@ -1511,7 +1699,7 @@ class StudentManagementDialog(tk.Toplevel):
         custom_vars = {}
         basic_names = {"姓名", "部門", "性別", "連絡電話", "餐飲葷素"}
         shown_names = set()
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT id, field_name, field_type, is_required 
@@ -1547,7 +1735,7 @@ class StudentManagementDialog(tk.Toplevel):
                 messagebox.showwarning("警告", "姓名不能為空")
                 return
             try:
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     h = hash_name(name)
                     c.execute("""
@@ -1555,13 +1743,8 @@ class StudentManagementDialog(tk.Toplevel):
                         VALUES (?, ?, ?, ?, ?, ?)
                     """, (name, dept, h, gender_var.get(), phone_var.get(), dietary_var.get()))
                     student_id = c.lastrowid
-                    for field_id, var in custom_vars.items():
-                        value = var.get().strip()
-                        if value:
-                            c.execute("""
-                                INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                VALUES (?, ?, ?)
-                            """, (student_id, field_id, value))
+                    save_custom_values(conn, [(student_id, field_id, var.get().strip())
+                                              for field_id, var in custom_vars.items()])
                     conn.commit()
                 dialog.destroy()
                 self.load_students()
@@ -1580,7 +1763,7 @@ class StudentManagementDialog(tk.Toplevel):
             messagebox.showwarning("警告", "一次只能編輯一個學員")
             return
 
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT name, department, gender, phone, dietary 
@@ -1619,7 +1802,7 @@ class StudentManagementDialog(tk.Toplevel):
         row += 1
         # 性別
         gender_var = tk.StringVar(value=gender)
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT option_value FROM field_options WHERE field_id=1 ORDER BY display_order")
             gender_options = [row_[0] for row_ in c.fetchall()]
@@ -1633,7 +1816,7 @@ class StudentManagementDialog(tk.Toplevel):
         row += 1
         # 餐飲葷素
         dietary_var = tk.StringVar(value=dietary)
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("SELECT option_value FROM field_options WHERE field_id=5 ORDER BY display_order")
             dietary_options = [row_[0] for row_ in c.fetchall()]
@@ -1648,7 +1831,7 @@ class StudentManagementDialog(tk.Toplevel):
         custom_vars = {}
         basic_names = {"姓名", "部門", "性別", "連絡電話", "餐飲葷素"}
         shown_names = set()
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_conn() as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT id, field_name, field_type, is_required 
@@ -1684,25 +1867,21 @@ class StudentManagementDialog(tk.Toplevel):
                 messagebox.showwarning("警告", "姓名不能為空")
                 return
             try:
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     h = hash_name(new_name)
+                    values = (new_name, new_dept, h, gender_var.get(), phone_var.get(), dietary_var.get())
                     c.execute("""
                         UPDATE students 
                         SET name=?, department=?, hash=?, gender=?, phone=?, dietary=?
-                        WHERE id=?
-                    """, (new_name, new_dept, h, gender_var.get(), phone_var.get(), dietary_var.get(), selected[0]))
-                    c.execute("DELETE FROM student_custom_values WHERE student_id=?", (selected[0],))
-                    for field_id, var in custom_vars.items():
-                        value = var.get().strip()
-                        if value:
-                            c.execute("""
-                                INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                VALUES (?, ?, ?)
-                            """, (selected[0], field_id, value))
+                        WHERE id=? AND (name, department, hash, gender, phone, dietary) IS NOT (?, ?, ?, ?, ?, ?)
+                    """, values + (selected[0],) + values)
+                    save_custom_values(conn, [(selected[0], field_id, var.get().strip())
+                                              for field_id, var in custom_vars.items()])
                     conn.commit()
                 dialog.destroy()
                 self.load_students()
+                self.notify_change()
             except sqlite3.IntegrityError:
                 messagebox.showerror("錯誤", "該學員名稱已存在")
         ttk.Button(btn_frame, text="儲存", command=save).pack(side=tk.LEFT, padx=5)
@@ -1725,7 +1904,7 @@ class StudentManagementDialog(tk.Toplevel):
         def load_fields():
             for row in tree.get_children():
                 tree.delete(row)
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_conn() as conn:
                 c = conn.cursor()
                 c.execute("""
                     SELECT id, field_name, field_type, is_required 
@@ -1758,7 +1937,7 @@ class StudentManagementDialog(tk.Toplevel):
                     messagebox.showwarning("警告", "欄位名稱不能為空")
                     return
 
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     c.execute("""
                         INSERT INTO custom_fields (field_name, field_type, is_required, display_order)
@@ -1791,7 +1970,7 @@ class StudentManagementDialog(tk.Toplevel):
                         ttk.Button(options_frame, text="新增選項", command=add_option).pack(pady=5)
 
                         def save_options():
-                            with sqlite3.connect(DB_FILE) as conn:
+                            with get_conn() as conn:
                                 c = conn.cursor()
                                 for i, option in enumerate(options_list):
                                     c.execute("""
@@ -1817,7 +1996,7 @@ class StudentManagementDialog(tk.Toplevel):
                 messagebox.showwarning("警告", "請選擇要刪除的欄位")
                 return
             if messagebox.askyesno("確認", "確定要刪除選取的欄位嗎？\n注意：刪除欄位將同時刪除所有相關的資料。"):
-                with sqlite3.connect(DB_FILE) as conn:
+                with get_conn() as conn:
                     c = conn.cursor()
                     for fid in selected:
                         c.execute("DELETE FROM field_options WHERE field_id=?", (fid,))
@@ -1841,189 +2020,31 @@ class StudentManagementDialog(tk.Toplevel):
             messagebox.showwarning("警告", "請選擇要刪除的學員")
             return
         if messagebox.askyesno("確認", f"確定要刪除選取的 {len(selected)} 位學員嗎？"):
-            with sqlite3.connect(DB_FILE) as conn:
+            with get_conn() as conn:
                 c = conn.cursor()
                 for sid in selected:
                     c.execute("DELETE FROM students WHERE id=?", (sid,))
                 conn.commit()
             self.load_students()
+            self.notify_change()
 
-    def import_students(self):
+    def import_students(self, dry_run=False):
         file_path = filedialog.askopenfilename(filetypes=[("Excel檔案", "*.xlsx;*.xls")])
         if not file_path:
             return
-        try:
-            wb = load_workbook(file_path)
-            ws = wb.active
-            rows = []
-            headers = [cell.value for cell in ws[1]]
-            for row in ws.iter_rows(min_row=2):
-                row_data = {}
-                for header, cell in zip(headers, row):
-                    row_data[header] = str(cell.value).strip() if cell.value else ""
-                rows.append(row_data)
-        except Exception as e:
-            messagebox.showerror("錯誤", f"讀取Excel檔案失敗：{str(e)}")
+        # 以唯讀串流方式讀取兩次：先比對重複學員，確認處理方式後再批次寫入
+        ImportProgressDialog(self, "檢查匯入檔" if dry_run else "匯入學員", ImportRun("students", file_path),
+                             lambda: iter_xlsx_rows(file_path), self.on_import_done, dry_run=dry_run)
+
+    def on_import_done(self, result, error):
+        if error is not None:
+            messagebox.showerror("錯誤", f"匯入Excel檔案失敗：{str(error)}", parent=self)
             return
-        
-        # 取得所有自定義欄位
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT id, field_name, field_type 
-                FROM custom_fields 
-                ORDER BY display_order
-            """)
-            custom_fields = c.fetchall()
-        
-        added = 0
-        skipped = 0
-        updated = 0
-        duplicate_action = None  # None=詢問, "skip"=跳過, "update"=更新, "skip_all"=跳過全部, "update_all"=強制更新全部
-        
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            for row in rows:
-                name = row.get("姓名", "").strip()
-                dept = row.get("部門", "").strip()
-                if not name:
-                    continue
-                
-                # 檢查學員是否已存在
-                c.execute("SELECT id FROM students WHERE name=?", (name,))
-                student = c.fetchone()
-                
-                if student:
-                    student_id = student[0]
-                    
-                    if duplicate_action is None:
-                        # 取得現有資料
-                        c.execute("""
-                            SELECT s.department, s.gender, s.phone, s.dietary,
-                                   f.field_name, scv.field_value
-                            FROM students s
-                            LEFT JOIN student_custom_values scv ON scv.student_id = s.id
-                            LEFT JOIN custom_fields f ON f.id = scv.field_id
-                            WHERE s.id = ?
-                            ORDER BY f.display_order
-                        """, (student_id,))
-                        existing_data = c.fetchall()
-                        
-                        existing_dept = existing_data[0][0] if existing_data else ""
-                        existing_gender = existing_data[0][1] if existing_data else ""
-                        existing_phone = existing_data[0][2] if existing_data else ""
-                        existing_dietary = existing_data[0][3] if existing_data else ""
-                        
-                        existing_custom = "\n".join([f"{row[4]}：{row[5]}" for row in existing_data if row[4] and row[5]])
-                        
-                        new_data = f"部門：{row.get('部門', '')}\n"
-                        new_data += f"性別：{row.get('性別', '')}\n"
-                        new_data += f"連絡電話：{row.get('連絡電話', '')}\n"
-                        new_data += f"餐飲葷素：{row.get('餐飲葷素', '')}\n"
-                        for field_id, field_name, _ in custom_fields:
-                            if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                                value = row.get(field_name, "")
-                                if value:
-                                    new_data += f"{field_name}：{value}\n"
-                        
-                        response = messagebox.askyesnocancel(
-                            "發現重複學員",
-                            f"發現重複學員：{name}\n\n"
-                            f"現有資料：\n"
-                            f"部門：{existing_dept}\n"
-                            f"性別：{existing_gender}\n"
-                            f"連絡電話：{existing_phone}\n"
-                            f"餐飲葷素：{existing_dietary}\n"
-                            f"{existing_custom}\n\n"
-                            f"新資料：\n{new_data}\n"
-                            "是否要覆蓋現有資料？\n"
-                            "是 = 覆蓋\n"
-                            "否 = 跳過\n"
-                            "取消 = 顯示更多選項"
-                        )
-                        
-                        if response is None:  # 取消，顯示更多選項
-                            response = messagebox.askyesnocancel(
-                                "更多選項",
-                                "選擇處理方式：\n"
-                                "是 = 跳過所有重複\n"
-                                "否 = 強制更新所有重複\n"
-                                "取消 = 返回上一層"
-                            )
-                            if response is None:  # 返回上一層
-                                continue
-                            elif response:  # 跳過所有重複
-                                duplicate_action = "skip_all"
-                                skipped += 1
-                                continue
-                            else:  # 強制更新所有重複
-                                duplicate_action = "update_all"
-                        elif response:  # 覆蓋
-                            duplicate_action = "update"
-                        else:  # 跳過
-                            duplicate_action = "skip"
-                            skipped += 1
-                            continue
-                    
-                    if duplicate_action == "skip_all":
-                        skipped += 1
-                        continue
-                    elif duplicate_action == "update_all":
-                        # 強制更新所有重複
-                        pass
-                    elif duplicate_action == "skip":
-                        skipped += 1
-                        continue
-                    elif duplicate_action == "update":
-                        # 更新基本資料
-                        c.execute("""
-                            UPDATE students 
-                            SET department=?, gender=?, phone=?, dietary=?
-                            WHERE id=?
-                        """, (dept, row.get("性別", ""), row.get("連絡電話", ""), 
-                              row.get("餐飲葷素", ""), student_id))
-                        
-                        # 更新自定義欄位值
-                        c.execute("DELETE FROM student_custom_values WHERE student_id=?", (student_id,))
-                        for field_id, field_name, _ in custom_fields:
-                            if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                                value = row.get(field_name, "").strip()
-                                if value:
-                                    c.execute("""
-                                        INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                        VALUES (?, ?, ?)
-                                    """, (student_id, field_id, value))
-                        updated += 1
-                        continue
-                
-                try:
-                    h = hash_name(name)
-                    # 插入基本資料
-                    c.execute("""
-                        INSERT INTO students (name, department, hash, gender, phone, dietary) 
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (name, dept, h,
-                          row.get("性別", ""),
-                          row.get("連絡電話", ""),
-                          row.get("餐飲葷素", "")))
-                    
-                    student_id = c.lastrowid
-                    
-                    # 插入其他自定義欄位值
-                    for field_id, field_name, _ in custom_fields:
-                        if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                            value = row.get(field_name, "").strip()
-                            if value:
-                                c.execute("""
-                                    INSERT INTO student_custom_values (student_id, field_id, field_value)
-                                    VALUES (?, ?, ?)
-                                """, (student_id, field_id, value))
-                    
-                    added += 1
-                except sqlite3.IntegrityError:
-                    continue
-            conn.commit()
-        
+        if result is None:
+            messagebox.showinfo("匯入取消", "已取消匯入，資料未變更", parent=self)
+            return
+        added, updated, skipped = result["added"], result["updated"], result["skipped"]
+
         result_message = f"匯入完成：\n"
         if added > 0:
             result_message += f"新增：{added} 位\n"
@@ -2032,7 +2053,7 @@ class StudentManagementDialog(tk.Toplevel):
         if skipped > 0:
             result_message += f"跳過：{skipped} 位"
         
-        messagebox.showinfo("匯入完成", result_message)
+        messagebox.showinfo("匯入完成", result_message, parent=self)
         self.load_students()
 
     def export_students(self):
@@ -2043,73 +2064,9 @@ class StudentManagementDialog(tk.Toplevel):
         if not file_path:
             return
 
-        # 取得所有自定義欄位
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT id, field_name, field_type 
-                FROM custom_fields 
-                ORDER BY display_order
-            """)
-            custom_fields = c.fetchall()
-
-            # 取得所有學員資料
-            c.execute("""
-                SELECT s.id, s.name, s.department, s.gender, s.phone, s.dietary,
-                       GROUP_CONCAT(f.field_name || ':' || v.field_value) as custom_values
-                FROM students s
-                LEFT JOIN student_custom_values v ON v.student_id = s.id
-                LEFT JOIN custom_fields f ON f.id = v.field_id
-                GROUP BY s.id
-                ORDER BY s.name
-            """)
-            students = c.fetchall()
-
-        # 準備欄位名稱
-        fieldnames = ["姓名", "部門", "性別", "連絡電話", "餐飲葷素"]
-        for _, field_name, _ in custom_fields:
-            if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                fieldnames.append(field_name)
-
         try:
-            wb = Workbook()
-            ws = wb.active
-            
-            # 寫入標題列
-            for col, fieldname in enumerate(fieldnames, 1):
-                ws.cell(row=1, column=col, value=fieldname)
-
-            # 寫入資料
-            for row_idx, student in enumerate(students, 2):
-                sid, name, dept, gender, phone, dietary, custom_values = student
-                ws.cell(row=row_idx, column=1, value=name)
-                ws.cell(row=row_idx, column=2, value=dept)
-                ws.cell(row=row_idx, column=3, value=gender)
-                ws.cell(row=row_idx, column=4, value=phone)
-                ws.cell(row=row_idx, column=5, value=dietary)
-
-                # 處理自定義欄位值
-                if custom_values:
-                    for pair in custom_values.split(','):
-                        field_name, value = pair.split(':')
-                        if field_name not in ["性別", "連絡電話", "餐飲葷素"]:
-                            col_idx = fieldnames.index(field_name) + 1
-                            ws.cell(row=row_idx, column=col_idx, value=value)
-
-            # 調整欄寬
-            for col in ws.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column].width = adjusted_width
-
-            wb.save(file_path)
+            with get_conn() as conn:
+                export_students_xlsx(conn, file_path)
             messagebox.showinfo("匯出完成", "學員資料已成功匯出")
         except Exception as e:
             messagebox.showerror("錯誤", f"匯出失敗：{str(e)}")
@@ -2164,8 +2121,10 @@ def main():
         root.withdraw()
         root.after(100, show_login)
 
+    update_db()
     show_login()
     root.mainloop()
+    close_conn()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,67 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_LOG_FILE = "scan_metrics.log"
+
+class ScanMetrics:
+    """掃描流程各階段的耗時統計（毫秒），只保留最近 window 筆樣本"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.new_samples = 0  # 上次寫入記錄檔後新增的樣本數
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - start) * 1000)
+
+    def record(self, stage, elapsed_ms):
+        # deque.append 為原子操作，TTS 背景執行緒也可以直接記錄
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples.setdefault(stage, deque(maxlen=self.window))
+        samples.append(elapsed_ms)
+        self.new_samples += 1
+
+    def percentiles(self, stage):
+        """回傳 {count, p50, p95, p99}，沒有樣本時回傳 None"""
+        samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return None
+        def pick(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+        return {"count": len(samples), "p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+    def summary(self):
+        return {stage: self.percentiles(stage) for stage in list(self.samples)}
+
+    def format_readout(self, stages, labels=None):
+        """狀態列用的簡短文字，例如「寫入 2/5/9ms」"""
+        labels = labels or {}
+        parts = []
+        for stage in stages:
+            stats = self.percentiles(stage)
+            if stats:
+                parts.append(f"{labels.get(stage, stage)} {stats['p50']:.0f}/{stats['p95']:.0f}/{stats['p99']:.0f}ms")
+        return "  ".join(parts)
+
+    def write_summary(self, log_file=METRICS_LOG_FILE):
+        """有新樣本時將目前統計附加一行 JSON 至記錄檔"""
+        if not self.new_samples:
+            return False
+        self.new_samples = 0
+        entry = {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "stages": {stage: {k: round(v, 2) for k, v in stats.items()}
+                       for stage, stats in self.summary().items() if stats},
+        }
+        with open(log_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return True
@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = "checkin.db"
+QR_SEED = "secure_seed_2024"
+
+# SQLite 效能設定
+BUSY_TIMEOUT = 5            # 等待其他連線釋放寫入鎖的秒數
+CACHE_SIZE_KB = 16384       # 每條連線的頁面快取（KiB）
+MMAP_SIZE = 64 * 1024 * 1024
+STATEMENT_CACHE_SIZE = 256  # 每條連線保留的預備陳述式數量
+
+# sqlite3 連線不能跨執行緒使用，因此每個執行緒各自保留一條長期連線
+_local = threading.local()
+
+def connect(db_file=None):
+    """建立新的 SQLite 連線並套用 WAL 及效能相關 PRAGMA"""
+    conn = sqlite3.connect(db_file or DB_FILE, timeout=BUSY_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_conn():
+    """取得目前執行緒的共用連線（第一次呼叫時建立）"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+        logger.info(f"SQLite 連線已建立：{DB_FILE}")
+    return conn
+
+def close_conn():
+    """關閉目前執行緒的共用連線"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.error(f"關閉 SQLite 連線時發生錯誤: {str(e)}")
+        _local.conn = None
+
+def hash_name(name):
+    return hashlib.sha256(f"{name}{QR_SEED}".encode()).hexdigest()
+
+def backup_code(h):
+    # 備用碼為 hash 前 10 碼，資料庫以 substr(hash, 1, 10) 運算式索引查詢
+    return h[:10]
+
+# toggle_checkin 回傳的狀態
+CHECKED_IN = "checked_in"
+CHECKED_OUT = "checked_out"
+ALREADY_DONE = "already_done"
+
+# RETURNING 需要 SQLite 3.35 以上
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# 未簽到 -> 簽到；已簽到未簽退 -> 簽退；已簽退則不更新（WHERE 不成立，不回傳任何列）
+# SET 中的欄位都是更新前的值，因此兩個 CASE 判斷的是同一個舊狀態
+_TOGGLE_SQL = """
+    INSERT INTO checkins (session_id, student_id, check_in_time) VALUES (?, ?, ?)
+    ON CONFLICT(session_id, student_id) DO UPDATE SET
+        check_in_time = CASE WHEN COALESCE(check_in_time, '') = ''
+                             THEN excluded.check_in_time ELSE check_in_time END,
+        check_out_time = CASE WHEN COALESCE(check_in_time, '') = ''
+                              THEN check_out_time ELSE excluded.check_in_time END
+    WHERE COALESCE(check_out_time, '') = ''
+"""
+
+def toggle_checkin(conn, session_id, student_id, now_str):
+    """以單一陳述式切換簽到/簽退狀態，回傳 (狀態, 簽到時間, 簽退時間)；由呼叫端負責 commit"""
+    params = (session_id, student_id, now_str)
+    if _HAS_RETURNING:
+        rows = conn.execute(_TOGGLE_SQL + " RETURNING check_in_time, check_out_time", params).fetchall()
+        row = rows[0] if rows else None
+    else:
+        cur = conn.execute(_TOGGLE_SQL, params)
+        row = None
+        if cur.rowcount > 0:
+            row = conn.execute("SELECT check_in_time, check_out_time FROM checkins WHERE session_id=? AND student_id=?",
+                               (session_id, student_id)).fetchone()
+    if row is None:
+        return ALREADY_DONE, None, None
+    check_in_time, check_out_time = row
+    # 更新前簽退時間必定為空，因此有簽退時間就代表這次是簽退
+    status = CHECKED_OUT if check_out_time else CHECKED_IN
+    return status, check_in_time, check_out_time
+
+# 自定義欄位值依 (student_id, field_id) 唯一索引寫入，內容相同時不更新
+_UPSERT_CUSTOM_VALUE_SQL = """
+    INSERT INTO student_custom_values (student_id, field_id, field_value) VALUES (?, ?, ?)
+    ON CONFLICT(student_id, field_id) DO UPDATE SET field_value = excluded.field_value
+    WHERE field_value IS NOT excluded.field_value
+"""
+
+def save_custom_values(conn, values):
+    """批次寫入自定義欄位值 (student_id, field_id, 值)；只更新有變動的值，空白值刪除。由呼叫端負責 commit"""
+    values = list(values)
+    conn.executemany(_UPSERT_CUSTOM_VALUE_SQL, [v for v in values if v[2]])
+    conn.executemany("DELETE FROM student_custom_values WHERE student_id=? AND field_id=?",
+                     [(student_id, field_id) for student_id, field_id, value in values if not value])
+
+# students 表本身的欄位（顯示名稱, 資料表欄位）
+STUDENT_COLUMNS = [("姓名", "name"), ("部門", "department"), ("性別", "gender"),
+                   ("連絡電話", "phone"), ("餐飲葷素", "dietary")]
+
+def student_custom_fields(conn):
+    """回傳自定義欄位 [(欄位名稱, [field_id, ...])]；同名欄位合併為一欄，已在 students 表的欄位除外"""
+    basic = {label for label, _ in STUDENT_COLUMNS}
+    fields = {}
+    for field_id, field_name in conn.execute("SELECT id, field_name FROM custom_fields ORDER BY display_order, id"):
+        if field_name not in basic:
+            fields.setdefault(field_name, []).append(field_id)
+    return list(fields.items())
+
+def iter_student_wide_rows(conn, fields=None, where="", params=(), order_by="s.name, s.id"):
+    """以單一查詢將自定義欄位值轉為欄位，逐位學員產生
+    (id, 姓名, 部門, 性別, 連絡電話, 餐飲葷素, 自定義欄位值...)；fields 為 student_custom_fields() 的結果
+    """
+    if fields is None:
+        fields = student_custom_fields(conn)
+    pivots = "".join(
+        f",\n            MAX(CASE WHEN v.field_id IN ({','.join(str(int(i)) for i in field_ids)}) THEN v.field_value END)"
+        for _, field_ids in fields)
+    columns = ", ".join(f"s.{column}" for _, column in STUDENT_COLUMNS)
+    yield from conn.execute(f"""
+        SELECT s.id, {columns}{pivots}
+        FROM students s
+        LEFT JOIN student_custom_values v ON v.student_id = s.id
+        {where}
+        GROUP BY s.id
+        ORDER BY {order_by}
+    """, params)
@@ -1,42 +1,106 @@
-import sqlite3
-
-def update_db():
-    with sqlite3.connect('checkin.db') as conn:
-        c = conn.cursor()
-        
-        # 檢查 type 欄位是否存在
-        c.execute("PRAGMA table_info(classes)")
-        columns = [column[1] for column in c.fetchall()]
-        
-        if 'type' not in columns:
-            # 備份現有的課程資料
-            c.execute("CREATE TABLE classes_backup AS SELECT * FROM classes")
-            
-            # 刪除舊的課程表
-            c.execute("DROP TABLE classes")
-            
-            # 創建新的課程表
-            c.execute("""
-            CREATE TABLE classes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL DEFAULT 'multi_session'
-            )
-            """)
-            
-            # 恢復課程資料，並設置預設類型
-            c.execute("""
-            INSERT INTO classes (id, name, type)
-            SELECT id, name, 'multi_session'
-            FROM classes_backup
-            """)
-            
-            # 刪除備份表
-            c.execute("DROP TABLE classes_backup")
-            
-            print("資料庫結構已更新")
-        else:
-            print("資料庫結構已經是最新的")
+from sqlite_db import get_conn
+from init_db import create_tables
+
+def _add_class_type(c):
+    # 檢查 type 欄位是否存在
+    c.execute("PRAGMA table_info(classes)")
+    columns = [column[1] for column in c.fetchall()]
+
+    if columns and 'type' not in columns:
+        # 備份現有的課程資料
+        c.execute("CREATE TABLE classes_backup AS SELECT * FROM classes")
+
+        # 刪除舊的課程表
+        c.execute("DROP TABLE classes")
+
+        # 創建新的課程表
+        c.execute("""
+        CREATE TABLE classes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL DEFAULT 'multi_session'
+        )
+        """)
+
+        # 恢復課程資料，並設置預設類型
+        c.execute("""
+        INSERT INTO classes (id, name, type)
+        SELECT id, name, 'multi_session'
+        FROM classes_backup
+        """)
+
+        # 刪除備份表
+        c.execute("DROP TABLE classes_backup")
+
+def _add_backup_code_index(c):
+    # 備用碼（hash 前 10 碼）查詢索引，手動簽到時使用
+    c.execute("CREATE INDEX IF NOT EXISTS idx_students_backup_code ON students(substr(hash, 1, 10))")
+
+def _add_lookup_indexes(c):
+    # 名單、簽到記錄、匯入及自定義欄位常用的查詢條件
+    c.execute("CREATE INDEX IF NOT EXISTS idx_class_students_student ON class_students(student_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_checkins_student ON checkins(student_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_students_name ON students(name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_custom_values_student_field ON student_custom_values(student_id, field_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_class_week ON sessions(class_id, week)")
+
+def _add_custom_value_unique_key(c):
+    # 同一學員同一欄位只保留最後寫入的值，再以唯一索引取代原本的查詢索引，供 UPSERT 使用
+    c.execute("""
+        DELETE FROM student_custom_values
+        WHERE id NOT IN (SELECT MAX(id) FROM student_custom_values GROUP BY student_id, field_id)
+    """)
+    c.execute("DROP INDEX IF EXISTS idx_custom_values_student_field")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_custom_values_unique ON student_custom_values(student_id, field_id)")
+
+def _add_checkin_time_indexes(c):
+    # 簽到歷史增量匯出依簽到、簽退時間篩選新記錄
+    c.execute("CREATE INDEX IF NOT EXISTS idx_checkins_check_in_time ON checkins(check_in_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_checkins_check_out_time ON checkins(check_out_time)")
+
+def _create_tables_if_new(c):
+    # 全新的資料庫沒有任何資料表，先建立基本結構，後續更新才有資料表可建立索引；
+    # 既有資料庫不重新執行，避免預設的自定義欄位重複新增
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='students'").fetchone():
+        create_tables(c)
+
+# 依序套用的結構更新，第 n 個（從 1 起算）套用後 user_version 即為 n
+# 只能在最後面新增，不可修改或調整既有項目的順序
+MIGRATIONS = [
+    _add_class_type,
+    _add_backup_code_index,
+    _add_lookup_indexes,
+    _add_custom_value_unique_key,
+    _add_checkin_time_indexes,
+]
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def update_db(conn=None):
+    conn = conn or get_conn()
+    version = get_version(conn)
+    if version >= len(MIGRATIONS):
+        return version
+
+    # 所有待套用的更新在同一個交易內完成，失敗時整批還原
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        if version == 0:
+            _create_tables_if_new(c)
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print(f"資料庫結構已更新：第 {version} 版 -> 第 {len(MIGRATIONS)} 版")
+    return len(MIGRATIONS)
 
 if __name__ == "__main__":
-    update_db() 
\ No newline at end of file
+    before = get_version(get_conn())
+    if update_db() == before:
+        print("資料庫結構已經是最新的")